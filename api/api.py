@@ -1,82 +1,190 @@
+import time
+import asyncio
+import logging
 import aiohttp
 import config
+from metrics import (
+    metadata_fetch_seconds, cdn_download_seconds, emote_get_seconds, transcode_seconds, transcode_pass_seconds,
+    transcoder_jobs, transcode_cache_events_total, transcode_cache_bytes, http_retries_total, http_connections_acquired
+)
 from api import Emote
 from api.errors import *
-from api.image import format_emote_for_discord
+from api.cache import TranscodeCache, MetadataCache
+from api.image import format_emote_for_discord_timed, ENCODER_VERSION
+from api.transcoder import Transcoder
+from api.transport import Transport
+from api.variants import VariantPlan, plan_variant
+
+logger = logging.getLogger(__name__)
 
 _api_endpoint = f"{config.SEVEN_TV_API_URL}/{config.SEVEN_TV_API_VERSION}"
 
 
 class EmotesAPI:
     def __init__(self):
-        self._session: aiohttp.ClientSession = None  # type: ignore
+        self._transport: Transport = Transport()
+        self.transcoder = Transcoder()
+        self.transcode_cache = TranscodeCache()
+        self.metadata_cache = MetadataCache()
+        # (emote id, options) -> task fetching it, shared by everyone asking for the same emote at the same time
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+
+        transcoder_jobs.set_function(lambda: self.transcoder.pending - self.transcoder.queue_depth, state="running")
+        transcoder_jobs.set_function(lambda: self.transcoder.queue_depth, state="queued")
+        transcode_cache_events_total.set_function(lambda: self.transcode_cache.hits, event="hit")
+        transcode_cache_events_total.set_function(lambda: self.transcode_cache.misses, event="miss")
+        transcode_cache_events_total.set_function(lambda: self.transcode_cache.evictions, event="eviction")
+        transcode_cache_bytes.set_function(lambda: self.transcode_cache.size)
+        http_retries_total.set_function(lambda: self.transport_stats()["retries"])
+        http_connections_acquired.set_function(lambda: self.transport_stats()["pool"]["acquired"])
 
     @staticmethod
-    def _get_fitting_emote(files: dict, animated: bool) -> dict | None:
-        search_for = f"4x.png" if not animated else f"3x.gif"
+    def _get_fitting_emote(files: list[dict], animated: bool) -> VariantPlan | None:
+        return plan_variant(files, animated)
 
-        for file in reversed(files):
-            if not file.get("name") == search_for:
-                continue
+    async def create_session(self):
+        await self._transport.start()
 
-            if not file.get("size") <= config.EMOJI_SIZE_LIMIT:
-                search_for = f"3x.png" if not animated else f"2x.gif"
-                continue
+    async def close(self):
+        await self._transport.close()
 
-            return file
+    def transport_stats(self) -> dict:
+        return self._transport.stats()
 
+    async def _download(self, url: str, max_size: int | None = None) -> bytes:
+        """
+        Streams the file into memory, aborting as soon as it's known to be bigger than `max_size`.
+        Chunks are joined once into an immutable bytes object, which io.BytesIO wraps without copying.
+        """
+        max_size = max_size or config.EMOTE_DOWNLOAD_MAX_SIZE
+        started_at = time.perf_counter()
 
-    async def create_session(self):
-        self._session = aiohttp.ClientSession()
+        with cdn_download_seconds.time():
+            async with await self._transport.get(url) as r:
+                if r.status != 200:
+                    raise EmoteBytesReadFail(f"Failed reading bytes from {url}")
 
-    async def _emote_get(self, emote_id: str) -> dict | None:
-        try:
-            response = await self._session.get(f"{_api_endpoint}/emotes/{emote_id}")
+                if r.content_length is not None and r.content_length > max_size:
+                    raise EmoteDownloadTooLarge(f"{url} is {r.content_length} bytes, limit is {max_size} bytes")
+
+                chunks = []
+                total = 0
+
+                async for chunk in r.content.iter_chunked(config.EMOTE_DOWNLOAD_CHUNK_SIZE):
+                    total += len(chunk)
+                    if total > max_size:
+                        raise EmoteDownloadTooLarge(f"{url} exceeded the limit of {max_size} bytes while downloading")
+
+                    chunks.append(chunk)
+
+        elapsed = time.perf_counter() - started_at
+        logger.debug(
+            f"Downloaded {url}: {total} bytes in {elapsed:.3f}s ({total / max(elapsed, 1e-6) / 1024:.1f} KiB/s)"
+        )
 
-        except aiohttp.InvalidURL:
-            raise aiohttp.InvalidURL(url=f"{_api_endpoint}/emotes/{emote_id}", description="No Such URL")
+        return b"".join(chunks)
 
-        match response.status:
-            case 404:
+    async def _emote_get(self, emote_id: str) -> dict | None:
+        cached = self.metadata_cache.get(emote_id)
+
+        if cached and cached.fresh:
+            if cached.data is None:
                 raise EmoteNotFound(emote_id)
 
-            case 200:
-                response_json = await response.json()
-                if response_json.get('status') == "Not Found":
+            return cached.data
+
+        headers = {}
+        if cached and cached.data is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        with metadata_fetch_seconds.time():
+            try:
+                response = await self._transport.get(f"{_api_endpoint}/emotes/{emote_id}", headers=headers)
+
+            except aiohttp.InvalidURL:
+                raise aiohttp.InvalidURL(url=f"{_api_endpoint}/emotes/{emote_id}", description="No Such URL")
+
+            match response.status:
+                case 304 if cached and cached.data is not None:
+                    response.release()
+                    self.metadata_cache.revalidated(emote_id)
+                    return cached.data
+
+                case 404:
+                    self.metadata_cache.store_not_found(emote_id)
                     raise EmoteNotFound(emote_id)
 
-                return response_json
+                case 200:
+                    response_json = await response.json()
+                    if response_json.get('status') == "Not Found":
+                        self.metadata_cache.store_not_found(emote_id)
+                        raise EmoteNotFound(emote_id)
+
+                    self.metadata_cache.store(emote_id, response_json, response.headers.get("ETag"))
+                    return response_json
 
     async def emote_get(self, emote_id: str, square_aspect_ratio=False, speed_up=False) -> Emote:
+        key = (emote_id, bool(square_aspect_ratio), bool(speed_up))
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._emote_fetch(emote_id, square_aspect_ratio, speed_up))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._in_flight.pop(key, None))
+
+        # Shielded, so one waiter giving up (f.e. interaction timing out) doesn't cancel the fetch for the rest.
+        with emote_get_seconds.time():
+            return await asyncio.shield(task)
+
+    async def _emote_fetch(self, emote_id: str, square_aspect_ratio=False, speed_up=False) -> Emote:
+        cached_emote = await self.transcode_cache.get(emote_id, square_aspect_ratio, speed_up, ENCODER_VERSION)
+        if cached_emote:
+            return cached_emote
+
+        emote_json = await self.emote_json_get(emote_id)
+        plan, emote_url, emote_bytes = await self.emote_download(emote_json)
+
+        return await self.emote_transcode(emote_json, plan, emote_url, emote_bytes, square_aspect_ratio, speed_up)
+
+    async def emote_json_get(self, emote_id: str) -> dict:
         emote_json = await self._emote_get(emote_id=emote_id)
 
         if not emote_json:
             raise EmoteJSONReadFail(f"Failed to read JSON for emote `{emote_id}`, most likely Invalid URL!")
 
+        return emote_json
+
+    async def emote_download(self, emote_json: dict) -> tuple[VariantPlan, str, bytes]:
         animated = emote_json.get("animated", False)
 
         fitting_emote = self._get_fitting_emote(emote_json["host"]["files"], animated)
         if not fitting_emote:
             raise FailedToFindFittingEmote
 
-        fitting_emote_url = f"https:{emote_json['host']['url']}/{fitting_emote.get('name')}"
+        fitting_emote_url = f"https:{emote_json['host']['url']}/{fitting_emote.name}"
 
-        r = await self._session.get(fitting_emote_url)
+        return fitting_emote, fitting_emote_url, await self._download(fitting_emote_url)
 
-        if r.status == 200:
-            emote_bytes = await r.read()
-        else:
-            raise EmoteBytesReadFail(f"Failed reading bytes from {fitting_emote_url}")
+    async def emote_transcode(
+            self, emote_json: dict, fitting_emote: VariantPlan, fitting_emote_url: str, emote_bytes: bytes,
+            square_aspect_ratio=False, speed_up=False
+    ) -> Emote:
+        animated = emote_json.get("animated", False)
+        width, height = fitting_emote.output_size
 
-        width, height = int(fitting_emote.get('width')), int(fitting_emote.get('height'))
+        with transcode_seconds.time():
+            emote_bytes, pass_timings = await self.transcoder.submit(
+                format_emote_for_discord_timed,
+                emote_bytes,
+                square_aspect_ratio,
+                speed_up,
+                fitting_emote.max_side
+            )
 
-        emote_bytes = await format_emote_for_discord(
-            emote_bytes,
-            square_aspect_ratio,
-            speed_up
-        )
+        for kind, seconds in pass_timings:
+            transcode_pass_seconds.observe(seconds, kind=kind)
 
-        return Emote(
+        emote = Emote(
             id=emote_json.get('id'),
             name=emote_json.get('name')[:32],
             format="gif" if animated else "png",
@@ -86,3 +194,27 @@ class EmotesAPI:
             emote_url=fitting_emote_url,
             emote_bytes=emote_bytes
         )
+
+        await self.transcode_cache.put(
+            emote, fitting_emote.key, square_aspect_ratio, speed_up, ENCODER_VERSION
+        )
+
+        return emote
+
+    async def emote_set_get(self, set_id: str) -> dict:
+        response = await self._transport.get(f"{_api_endpoint}/emote-sets/{set_id}")
+
+        async with response:
+            match response.status:
+                case 404:
+                    raise EmoteSetNotFound(set_id)
+
+                case 200:
+                    response_json = await response.json()
+                    if response_json.get('status') == "Not Found":
+                        raise EmoteSetNotFound(set_id)
+
+                    return response_json
+
+                case _:
+                    raise EmoteJSONReadFail(f"Failed to read JSON for emote set `{set_id}`, most likely Invalid URL!")
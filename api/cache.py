@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+
+import config
+from api.emote import Emote
+
+logger = logging.getLogger(__name__)
+
+
+class TranscodeCache:
+    """
+    Persistent LRU cache of Discord-ready emote bytes.
+
+    Entries are content-addressed by (7TV emote id, file variant, fit_to_square, speed_up, encoder version) and stored
+    as `<key>.bin` next to a `<key>.json` with the rest of the Emote fields, so a hit can be served without asking 7TV.
+    7TV never changes the files behind an emote id, which is why entries don't expire, they are only evicted.
+    """
+
+    def __init__(self, directory: str | None = None, max_size: int | None = None):
+        self.directory: str = directory or config.TRANSCODE_CACHE_DIR
+        self.max_size: int = max_size if max_size is not None else config.TRANSCODE_CACHE_MAX_SIZE
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        # key -> size in bytes, least recently used first
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        # (emote id, fit_to_square, speed_up, encoder version) -> key
+        self._lookup: dict[tuple, str] = {}
+        self._lookup_keys: dict[str, tuple] = {}
+        self._size: int = 0
+        self._loaded: bool = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @staticmethod
+    def make_key(emote_id: str, variant: str, fit_to_square: bool, speed_up: bool, encoder_version: int) -> str:
+        raw = f"{emote_id}:{variant}:{int(fit_to_square)}:{int(speed_up)}:{encoder_version}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _scan(self) -> list[tuple[float, str, int, dict]]:
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+
+            key = file_name[:-5]
+            try:
+                with open(self._path(key, "json")) as f:
+                    meta = json.load(f)
+                stat = os.stat(self._path(key, "bin"))
+            except (OSError, ValueError):
+                continue
+
+            found.append((stat.st_mtime, key, stat.st_size, meta))
+
+        return sorted(found)
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+
+        for _, key, size, meta in await asyncio.to_thread(self._scan):
+            self._remember(key, size, meta)
+
+        self._loaded = True
+        logger.info(f"Transcode cache loaded: {len(self._entries)} entries, {self.size} bytes")
+
+    @staticmethod
+    def _lookup_key(meta: dict) -> tuple:
+        return meta["id"], meta["fit_to_square"], meta["speed_up"], meta["encoder_version"]
+
+    def _read(self, key: str) -> tuple[dict, bytes]:
+        with open(self._path(key, "json")) as f:
+            meta = json.load(f)
+        with open(self._path(key, "bin"), "rb") as f:
+            data = f.read()
+
+        # mtime doubles as the last access time, so LRU order survives restarts
+        os.utime(self._path(key, "bin"))
+
+        return meta, data
+
+    def _write(self, key: str, meta: dict, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+
+        for extension, content, mode in (("bin", data, "wb"), ("json", json.dumps(meta), "w")):
+            tmp_path = self._path(key, f"{extension}.tmp")
+            with open(tmp_path, mode) as f:
+                f.write(content)
+            os.replace(tmp_path, self._path(key, extension))
+
+    def _delete(self, keys: list[str]):
+        for key in keys:
+            for extension in ("json", "bin"):
+                try:
+                    os.remove(self._path(key, extension))
+                except FileNotFoundError:
+                    pass
+
+    def _remember(self, key: str, size: int, meta: dict):
+        self._forget(key)
+        self._entries[key] = size
+        self._lookup_keys[key] = self._lookup_key(meta)
+        self._lookup[self._lookup_keys[key]] = key
+        self._size += size
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return
+
+        self._size -= size
+        lookup_key = self._lookup_keys.pop(key)
+        if self._lookup.get(lookup_key) == key:
+            del self._lookup[lookup_key]
+
+    async def get(self, emote_id: str, fit_to_square: bool, speed_up: bool, encoder_version: int) -> Emote | None:
+        await self._ensure_loaded()
+
+        key = self._lookup.get((emote_id, fit_to_square, speed_up, encoder_version))
+        if key is None:
+            self.misses += 1
+            return None
+
+        try:
+            meta, data = await asyncio.to_thread(self._read, key)
+        except (OSError, ValueError):
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return Emote(
+            id=meta["id"],
+            name=meta["name"],
+            format=meta["format"],
+            animated=meta["animated"],
+            width=meta["width"],
+            height=meta["height"],
+            emote_url=meta["emote_url"],
+            emote_bytes=data
+        )
+
+    async def put(self, emote: Emote, variant: str, fit_to_square: bool, speed_up: bool, encoder_version: int):
+        await self._ensure_loaded()
+
+        if len(emote.emote_bytes) > self.max_size:
+            return
+
+        key = self.make_key(emote.id, variant, fit_to_square, speed_up, encoder_version)
+
+        meta = asdict(emote)
+        meta.pop("emote_bytes")
+        meta.update(variant=variant, fit_to_square=fit_to_square, speed_up=speed_up, encoder_version=encoder_version)
+
+        try:
+            await asyncio.to_thread(self._write, key, meta, emote.emote_bytes)
+        except OSError as e:
+            logger.warning(f"Failed to write transcode cache entry {key}: {e}")
+            return
+
+        self._remember(key, len(emote.emote_bytes), meta)
+
+        await self._evict()
+
+    async def _evict(self):
+        victims = []
+
+        while self._size > self.max_size and self._entries:
+            key = next(iter(self._entries))
+            self._forget(key)
+            victims.append(key)
+
+        if victims:
+            self.evictions += len(victims)
+            await asyncio.to_thread(self._delete, victims)
+
+
+@dataclass
+class MetadataEntry:
+    data: dict | None  # None means 7TV answered with "not found"
+    etag: str | None
+    expires_at: float
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires_at
+
+
+class MetadataCache:
+    """
+    Bounded in-memory cache of 7TV emote JSON. Not found results are cached too, with their own (shorter) TTL.
+    Stale entries are kept around until evicted, so their ETag can be used to revalidate them.
+    """
+
+    def __init__(self, max_entries: int | None = None, ttl: float | None = None, not_found_ttl: float | None = None):
+        self.max_entries: int = max_entries or config.METADATA_CACHE_MAX_ENTRIES
+        self.ttl: float = ttl if ttl is not None else config.METADATA_CACHE_TTL
+        self.not_found_ttl: float = not_found_ttl if not_found_ttl is not None else config.METADATA_CACHE_NOT_FOUND_TTL
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.revalidations: int = 0
+
+        self._entries: OrderedDict[str, MetadataEntry] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, emote_id: str) -> MetadataEntry | None:
+        """Returns the entry even if it's stale, check `entry.fresh` before using it as is."""
+        entry = self._entries.get(emote_id)
+
+        if entry is None or not entry.fresh:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        if entry is not None:
+            self._entries.move_to_end(emote_id)
+
+        return entry
+
+    def _set(self, emote_id: str, entry: MetadataEntry):
+        self._entries[emote_id] = entry
+        self._entries.move_to_end(emote_id)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def store(self, emote_id: str, data: dict, etag: str | None = None):
+        self._set(emote_id, MetadataEntry(data, etag, time.monotonic() + self.ttl))
+
+    def store_not_found(self, emote_id: str):
+        self._set(emote_id, MetadataEntry(None, None, time.monotonic() + self.not_found_ttl))
+
+    def revalidated(self, emote_id: str):
+        """7TV confirmed the stale entry is still up to date (304 Not Modified)."""
+        entry = self._entries.get(emote_id)
+        if entry is None:
+            return
+
+        self.revalidations += 1
+        entry.expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self, emote_id: str):
+        self._entries.pop(emote_id, None)
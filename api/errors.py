@@ -3,6 +3,11 @@ class EmoteNotFound(Exception):
         super().__init__(f"Emote `{emote_id}` not found.")
 
 
+class EmoteSetNotFound(Exception):
+    def __init__(self, set_id: str):
+        super().__init__(f"Emote set `{set_id}` not found.")
+
+
 class EmoteBytesReadFail(Exception):
     def __init__(self, message: str):
         super().__init__(message)
@@ -15,3 +20,28 @@ class EmoteJSONReadFail(Exception):
 
 class FailedToFindFittingEmote(Exception):
     pass
+
+
+class TranscoderSaturated(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class TranscodeTimeout(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class TranscoderCrashed(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class EmoteDownloadTooLarge(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class SevenTVUnavailable(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
@@ -1,64 +1,467 @@
 import io
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
 import config
-from PIL import Image, GifImagePlugin
+from PIL import Image, ImageChops, GifImagePlugin
 GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
 
-async def process_gif(image: Image, compress_factor: int = 1, fit_to_square: bool = False, speed_up: bool = False):
-    frames = []
-    output = io.BytesIO()
-    smaller_side = min(image.size)
+# Bump whenever the output of format_emote_for_discord changes for the same input.
+ENCODER_VERSION: int = 9
+
+# Frames are compared on thumbnails of this size, cheap and forgiving of dithering noise.
+_THUMBNAIL_SIZE: tuple[int, int] = (16, 16)
+
+# (kind, seconds) of every encode pass of the last format_emote_for_discord call.
+# Transcodes run in worker processes, so timings are handed back with the result instead of recorded there.
+_pass_timings: list[tuple[str, float]] = []
+
+
+@contextmanager
+def _timed_pass(kind: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        _pass_timings.append((kind, time.perf_counter() - started_at))
+
+
+def _target_size(size: tuple[int, int], fit_to_square: bool = False, max_side: int | None = None) -> tuple[int, int]:
+    width, height = size
+
+    if fit_to_square:
+        width = height = min(size)
+
+    if max_side is not None and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+
+    return width, height
+
+
+class FrameSource:
+    """
+    Decoded frames of an animation, already resized to the target size, shared by every encode pass of one job.
+    Frames are decoded on first use and kept while they fit in what's left of `memory_budget` bytes after
+    Pillow's GIF writer, which holds every frame of a pass quantized. Frames past it are decoded again when needed.
+    """
+
+    def __init__(
+            self, image: Image, fit_to_square: bool = False, max_side: int | None = None,
+            memory_budget: int = config.TRANSCODE_MEMORY_BUDGET
+    ):
+        self.image: Image = image
+        self.target_size: tuple[int, int] = _target_size(image.size, fit_to_square, max_side)
+        width, height = self.target_size
+        self.cache_budget: int = max(0, memory_budget - width * height * self.n_frames)
+
+        self.decoded: int = 0  # frames decoded so far, including repeated decodes of frames past the budget
+        self._frames: dict[int, Image] = {}
+        self._durations: dict[int, int] = {}
+        self._thumbnails: dict[int, Image] = {}  # tiny, kept for every frame regardless of the budget
+        self._palettes: dict[int, SharedPalette] = {}
+        self._pinned: set[int] = set()  # sampled frames, kept past the budget
+        self._cached_bytes: int = 0
+
+    @property
+    def n_frames(self) -> int:
+        return getattr(self.image, "n_frames", 1)
+
+    def frame(self, n_frame: int) -> Image:
+        frame = self._frames.get(n_frame)
+        if frame is not None:
+            return frame
+
+        frame = self._decode(n_frame)
+
+        frame_bytes = frame.width * frame.height * len(frame.getbands())
+        if self._cached_bytes + frame_bytes <= self.cache_budget:
+            self._frames[n_frame] = frame
+            self._cached_bytes += frame_bytes
+
+        return frame
+
+    def sample(self, count: int) -> list[int]:
+        """
+        :return: Indexes of `count` evenly spread frames. They are kept decoded even past the budget,
+        every trial encode and palette uses them, and seeking back in a GIF decodes it from the start again.
+        """
+        step = self.n_frames / min(self.n_frames, count)
+        frame_indexes = sorted({int(i * step) for i in range(min(self.n_frames, count))})
+
+        for n_frame in frame_indexes:
+            if n_frame not in self._frames:
+                self._frames[n_frame] = self._decode(n_frame)
+
+        self._pinned.update(frame_indexes)
+        return frame_indexes
+
+    def release(self):
+        """Frees the cached frames, except the sampled ones, once passes over this source are unlikely."""
+        self._frames = {n_frame: frame for n_frame, frame in self._frames.items() if n_frame in self._pinned}
+        self._cached_bytes = 0
+
+    def _decode(self, n_frame: int) -> Image:
+        self.image.seek(n_frame)
+        # resampling already returns a new image, otherwise copy, since seeking mutates the original
+        if self.image.size != self.target_size:
+            frame = _resample(self.image, self.target_size)
+        else:
+            frame = self.image.copy()
+        self.decoded += 1
+
+        if n_frame not in self._thumbnails:
+            self._durations[n_frame] = self.image.info.get('duration') or 100
+            # shrunk before converting where the mode allows it, converting the full frame is the expensive part
+            thumbnail = frame if frame.mode in ("RGB", "RGBA") else frame.convert("RGBA")
+            thumbnail = thumbnail.resize(_THUMBNAIL_SIZE, Image.Resampling.BOX).convert("RGBA")
+            # premultiplied, so fully transparent pixels compare equal whatever their colour
+            self._thumbnails[n_frame] = thumbnail.convert("RGBa")
+
+        return frame
+
+    def frames(self, frame_indexes: list[int]) -> Iterator[Image]:
+        return (self.frame(n_frame) for n_frame in frame_indexes)
+
+    def palette(self, colors: int) -> "SharedPalette":
+        if colors not in self._palettes:
+            self._palettes[colors] = SharedPalette.build(self, colors)
+
+        return self._palettes[colors]
+
+    def duration(self, n_frame: int) -> int:
+        if n_frame not in self._durations:
+            self.frame(n_frame)
+
+        return self._durations[n_frame]
+
+    def difference(self, first: int, second: int) -> float:
+        """:return: Mean per-channel difference of two frames, from 0 (same) to 255."""
+        for n_frame in (first, second):
+            if n_frame not in self._thumbnails:
+                self.frame(n_frame)
+
+        difference = ImageChops.difference(self._thumbnails[first], self._thumbnails[second])
+        # box-resizing to a single pixel averages in C, a lot faster than ImageStat
+        return sum(difference.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))) / 4
+
+
+def decimate_frames(source: FrameSource, compress_factor: int = 1, speed_up: bool = False) -> list[tuple[int, int]]:
+    """
+    Picks which frames to encode. Frames that (nearly) repeat the previous kept one are merged into it first,
+    then the least different frames are merged until only 1/compress_factor of the distinct frames are left,
+    so the most distinct motion survives instead of every Nth frame.
+    Merged frames add their duration to the frame they were merged into, unless `speed_up` is set,
+    in which case only near-identical merges do and the animation plays faster.
+    :return: (frame index, duration) of every frame to encode, in order.
+    """
+    kept = list(range(source.n_frames))
+    durations = [source.duration(n_frame) for n_frame in kept]
+    # differences[i] is the difference of kept[i] to kept[i - 1], the cost of merging it away
+    differences = [math.inf] + [source.difference(n_frame - 1, n_frame) for n_frame in kept[1:]]
+
+    target = None
+    while len(kept) > 1:
+        index = min(range(1, len(kept)), key=differences.__getitem__)
+        near_identical = differences[index] <= config.GIF_FRAME_MERGE_THRESHOLD
+
+        if not near_identical:
+            if target is None:
+                target = math.ceil(len(kept) / compress_factor)
+            if len(kept) <= target:
+                break
+
+        if near_identical or not speed_up:
+            durations[index - 1] += durations[index]
+
+        del kept[index], durations[index], differences[index]
+        if index < len(kept):
+            differences[index] = source.difference(kept[index - 1], kept[index])
+
+    return list(zip(kept, durations))
+
+
+class SharedPalette:
+    """
+    One adaptive palette for every frame of an animation, built from a sample of its frames.
+    Mapping frames onto a fixed palette is a lot cheaper than quantizing each of them, and the GIF only needs
+    a single global colour table instead of one per frame.
+    """
+
+    def __init__(self, palette: bytes, transparent_index: int | None):
+        self.transparent_index: int | None = transparent_index
+        self.palette: bytes = palette
+
+        # frames are mapped on the opaque colours only, so nothing opaque turns transparent
+        opaque_colors = palette if transparent_index is None else palette[:transparent_index * 3]
+        self._mapping_image = Image.new("P", (1, 1))
+        self._mapping_image.putpalette(opaque_colors)
+
+    @classmethod
+    def build(cls, source: FrameSource, colors: int) -> "SharedPalette":
+        transparent = source.image.has_transparency_data
+        frame_indexes = source.sample(config.GIF_PALETTE_SAMPLE_FRAMES)
+        width, height = source.target_size
+
+        # quantizing one mosaic of the sampled frames gives the palette that suits all of them best
+        mosaic = Image.new("RGB", (width * len(frame_indexes), height))
+        for index, n_frame in enumerate(frame_indexes):
+            frame = source.frame(n_frame).convert("RGBA")
+            mosaic.paste(frame, (index * width, 0), mask=frame if transparent else None)
+
+        quantized = mosaic.quantize(colors - 1 if transparent else colors, dither=Image.Dither.NONE)
+        palette = quantized.getpalette()[:len(set(quantized.getdata())) * 3] or [0, 0, 0]
+        # GIF writing looks palette entries up by colour, so they have to be unique
+        opaque_colors = list(dict.fromkeys(zip(palette[0::3], palette[1::3], palette[2::3])))
+
+        transparent_index = None
+        if transparent:
+            transparent_index = len(opaque_colors)
+            opaque_colors.append(next(
+                color for color in ((255, 0, value) for value in range(256)) if color not in opaque_colors
+            ))
 
-    for n_frame in range(0, image.n_frames, compress_factor):
-        image.seek(n_frame)
-        frame_img = image.copy()
+        return cls(bytes(channel for color in opaque_colors for channel in color), transparent_index)
 
-        if fit_to_square:
-            frame_img = frame_img.resize((smaller_side, smaller_side))
+    def map(self, frame: Image) -> Image:
+        mapped = frame.convert("RGB").quantize(palette=self._mapping_image, dither=Image.Dither.NONE)
+        mapped.putpalette(self.palette)
 
-        frames.append(frame_img)
+        if self.transparent_index is not None:
+            alpha = frame.convert("RGBA").getchannel("A")
+            mapped.paste(self.transparent_index, mask=alpha.point(lambda value: 255 if value < 128 else 0, "1"))
 
-    duration = image.info.get('duration', 100)
-    if not speed_up:
-        duration = duration * compress_factor
+        return mapped
 
-    frames[0].save(
+
+def _resample(image: Image, size: tuple[int, int]) -> Image:
+    """Resizes with the configured filter. Palette images are converted first, Pillow only resizes them with NEAREST."""
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+    # reducing_gap shrinks big sources by whole factors first, a lot faster and hardly distinguishable
+    return image.resize(size, Image.Resampling[config.IMAGE_RESAMPLE_FILTER], reducing_gap=3.0)
+
+
+def _encode_gif_frames(
+        source: FrameSource, frame_indexes: list[int], duration: int | list[int], colors: int | None = None
+) -> bytes:
+    """:param colors: Size of the palette shared by all frames, None to let Pillow quantize every frame on its own."""
+    output = io.BytesIO()
+    # Frames are handed to Pillow one by one, it only keeps their quantized (1 byte per pixel) versions.
+    frames = source.frames(frame_indexes)
+    palette_options = {}
+
+    if colors is not None:
+        palette = source.palette(colors)
+        frames = (palette.map(frame) for frame in frames)
+        palette_options["palette"] = palette.palette
+        if palette.transparent_index is not None:
+            palette_options["transparency"] = palette.transparent_index
+
+    next(frames).save(
         output,
         format="GIF",
-        append_images=frames[1:],
-        disposal=2 if image.has_transparency_data else 1,
+        append_images=frames,
+        disposal=2 if source.image.has_transparency_data else 1,
         save_all=True,
         optimize=True,
         interlace=False,
-        duration=duration
+        duration=duration,
+        **palette_options
     )
 
     return output.getvalue()
 
-async def format_emote_for_discord(initial_image_bytes, fit_to_square: bool = False, speed_up: bool = False):
-    image = Image.open(io.BytesIO(initial_image_bytes))
 
-    if image.format == "GIF":
-        result = None
-        compress_factor = 1
+def process_gif(
+        image: Image, compress_factor: int = 1, fit_to_square: bool = False, speed_up: bool = False,
+        max_side: int | None = None, source: FrameSource | None = None, colors: int | None = None
+):
+    """
+    :param source: Frames decoded by previous passes over the same image, to reuse them.
+    :param colors: Size of the palette shared by all frames, None to quantize every frame on its own.
+    """
+    if source is None:
+        source = FrameSource(image, fit_to_square, max_side)
+
+    frame_indexes, durations = zip(*decimate_frames(source, compress_factor, speed_up))
+
+    with _timed_pass("full"):
+        return _encode_gif_frames(source, list(frame_indexes), list(durations), colors)
+
+
+def _palette_sizes() -> list[int | None]:
+    return config.GIF_PALETTE_SIZES if config.GIF_SHARED_PALETTE else [None]
+
+
+def estimate_gif_frame_size(source: FrameSource, colors: int | None = None) -> float:
+    """
+    Cheap trial encode of a few evenly spread frames, used to predict the size of a full encode.
+    Sampled frames are further apart than neighbouring ones, so the estimate leans to the bigger side.
+    :return: Average amount of bytes per encoded frame.
+    """
+    frame_indexes = source.sample(config.GIF_SIZE_ESTIMATE_SAMPLE_FRAMES)
+
+    with _timed_pass("trial"):
+        sample = _encode_gif_frames(source, frame_indexes, source.image.info.get('duration', 100), colors)
+
+    return len(sample) / len(frame_indexes)
+
+
+def _encode_levels(
+        sides: list[int | None], palettes: list[int | None], n_frames: int
+) -> list[tuple[int | None, int, int | None]]:
+    """
+    (max side, compress factor, palette size) triples, from the best looking to the smallest output.
+    Sides down to EMOJI_DISPLAY_SIZE cost little, emojis are shown smaller anyway, so they go before dropping frames.
+    Smaller sides are the last resort, after dropping as many frames as allowed. Past that, frames keep being
+    dropped at the smallest side and palette, the last level being a single frame.
+    :param palettes: Palette sizes from the biggest output to the smallest, None for per-frame palettes.
+    """
+    sharp_sides = [side for side in sides if side is None or side >= config.EMOJI_DISPLAY_SIZE]
+    small_sides = [side for side in sides if side is not None and side < config.EMOJI_DISPLAY_SIZE]
+
+    levels = [
+        (side, compress_factor, colors)
+        for compress_factor in range(1, config.GIF_MAX_COMPRESS_FACTOR + 1)
+        for colors in palettes
+        for side in sharp_sides
+    ]
+    levels += [
+        (side, config.GIF_MAX_COMPRESS_FACTOR, colors) for side in small_sides for colors in palettes
+    ]
+
+    smallest_side, compress_factor, smallest_palette = levels[-1]
+    while compress_factor < n_frames:
+        compress_factor = min(compress_factor * 2, n_frames)
+        levels.append((smallest_side, compress_factor, smallest_palette))
+
+    return levels
+
+
+def _pick_level(
+        levels: list[tuple[int | None, int, int | None]], n_frames: int,
+        frame_size: Callable[[int | None, int | None], float], start: int = 0
+) -> int:
+    """
+    :param frame_size: Predicted bytes per frame for a side and palette size, only asked for the levels checked.
+    :return: Index of the first level from `start` predicted to fit, or the last one.
+    """
+    for index in range(start, len(levels)):
+        side, compress_factor, colors = levels[index]
+        if frame_size(side, colors) * math.ceil(n_frames / compress_factor) < config.EMOJI_SIZE_LIMIT:
+            return index
+
+    return len(levels) - 1
 
-        while True and compress_factor <= 4:
-            result = await process_gif(
-                image, compress_factor=compress_factor, fit_to_square=fit_to_square, speed_up=speed_up
-            )
-            if len(result) < config.EMOJI_SIZE_LIMIT:
-                return result
 
-            compress_factor += 1
+def _ladder_sides(size: tuple[int, int]) -> list[int | None]:
+    """None (the size as is) and every step of the resize ladder below it."""
+    return [None] + [side for side in config.DOWNSCALE_LADDER if side < max(size)]
 
-        return result
 
+def _format_gif(image: Image, fit_to_square: bool, speed_up: bool, max_side: int | None) -> bytes:
+    # Frames are resampled once per side, from the decoded original, and shared by the estimates and encodes of it
+    sources: dict[int | None, FrameSource] = {None: FrameSource(image, fit_to_square, max_side)}
+
+    def source_for(side: int | None) -> FrameSource:
+        if side not in sources:
+            # moving down the ladder, frames of the bigger sides won't be encoded again
+            for source in sources.values():
+                source.release()
+            sources[side] = FrameSource(image, fit_to_square, side)
+        return sources[side]
+
+    trial_sizes: dict[tuple[int | None, int | None], float] = {}
+
+    def trial_size(side: int | None, colors: int | None) -> float:
+        if (side, colors) not in trial_sizes:
+            trial_sizes[side, colors] = estimate_gif_frame_size(source_for(side), colors)
+        return trial_sizes[side, colors]
+
+    palettes = _palette_sizes()
+    if palettes[0] is not None and trial_size(None, None) <= trial_size(None, palettes[0]):
+        # Noisy or grainy frames differ too much for one palette to cover them, mapped onto it they compress worse
+        # than with a palette of their own. Per-frame palettes look at least as good, so they win outright then.
+        palettes = [None] + palettes[1:]
+
+    def frame_size(side: int | None, colors: int | None) -> float:
+        # Downscaled frames don't shrink with their area, anti-aliased edges compress worse, so every side is
+        # trial-encoded once, with the biggest palette. Other palette sizes are scaled by how they did at full size.
+        biggest_palette = palettes[0]
+        if side is None or colors == biggest_palette:
+            return trial_size(side, colors)
+
+        return trial_size(side, biggest_palette) * trial_size(None, colors) / trial_size(None, biggest_palette)
+
+    # Predict which level fits instead of trying them one by one, at most two full encodes are made:
+    # the predicted one and, if it misses, a corrected one.
+    distinct_frames = len(decimate_frames(sources[None]))
+    levels = _encode_levels(_ladder_sides(sources[None].target_size), palettes, distinct_frames)
+    level = _pick_level(levels, distinct_frames, frame_size)
+
+    side, compress_factor, colors = levels[level]
+    result = process_gif(
+        image, compress_factor=compress_factor, speed_up=speed_up, source=source_for(side), colors=colors
+    )
+
+    if len(result) >= config.EMOJI_SIZE_LIMIT and level < len(levels) - 1:
+        # Prediction was off, correct it with the real result and jump straight to the next predicted fit.
+        # Trial encodes of other sides can be off by a different amount, hence the margin. Only when nothing
+        # animated is predicted to fit does it come down to the last level, a single frame.
+        correction = len(result) / (frame_size(side, colors) * math.ceil(distinct_frames / compress_factor))
+        level = _pick_level(
+            levels, distinct_frames,
+            lambda size, palette: frame_size(size, palette) * correction / config.GIF_CORRECTED_FIT_MARGIN,
+            start=level + 1
+        )
+
+        side, compress_factor, colors = levels[level]
+        result = process_gif(
+            image, compress_factor=compress_factor, speed_up=speed_up, source=source_for(side), colors=colors
+        )
+
+    return result
+
+
+def _format_static(image: Image, fit_to_square: bool, max_side: int | None) -> bytes:
+    target_size = _target_size(image.size, fit_to_square, max_side)
+
+    for side in _ladder_sides(target_size):
+        size = _target_size(image.size, fit_to_square, side or max_side)
 
-    else:
         output = io.BytesIO()
-        smaller_side = min(image.size)
-        if fit_to_square:
-            image = image.resize((smaller_side, smaller_side))
+        with _timed_pass("static"):
+            (_resample(image, size) if image.size != size else image).save(output, format="PNG")
+
+        if output.tell() < config.EMOJI_SIZE_LIMIT:
+            break
+
+    return output.getvalue()
+
+
+def format_emote_for_discord(
+        initial_image_bytes, fit_to_square: bool = False, speed_up: bool = False, max_side: int | None = None
+) -> bytes:
+    """
+    Converts any image Pillow can read into a GIF (animated) or PNG (static) that fits under EMOJI_SIZE_LIMIT,
+    downscaling along DOWNSCALE_LADDER and dropping frames as needed.
+    :param max_side: Downscale so the bigger side is at most this many pixels.
+    """
+    _pass_timings.clear()
+    image = Image.open(io.BytesIO(initial_image_bytes))
+
+    if image.format == "GIF" or getattr(image, "is_animated", False):
+        return _format_gif(image, fit_to_square, speed_up, max_side)
+
+    return _format_static(image, fit_to_square, max_side)
 
-        image.save(output, format="PNG")
 
-        return output.getvalue()
+def format_emote_for_discord_timed(*args, **kwargs) -> tuple[bytes, list[tuple[str, float]]]:
+    """
+    Same as format_emote_for_discord, also returning (kind, seconds) of every encode pass it took.
+    Kinds are "trial" (size estimates), "full" (whole GIF) and "static" (PNG).
+    """
+    return format_emote_for_discord(*args, **kwargs), list(_pass_timings)
@@ -0,0 +1,101 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Any
+
+import config
+from api.errors import TranscoderSaturated, TranscodeTimeout, TranscoderCrashed
+
+logger = logging.getLogger(__name__)
+
+
+class Transcoder:
+    """
+    Runs CPU-heavy Pillow work in a process pool, so it never blocks the bot's event loop.
+    Amount of queued jobs is bounded, new jobs are rejected once the queue is full.
+
+    Jobs past `job_timeout` are only given up on, a worker process can't be interrupted, so the job keeps running
+    and holds its worker (and its queue slot) until it finishes. A worker dying (f.e. OOM-killed) breaks the whole
+    pool, it is replaced by a new one for the next job.
+    """
+
+    def __init__(
+            self, max_workers: int | None = None, max_queue: int | None = None, job_timeout: float | None = None
+    ):
+        self.max_workers: int = max_workers or config.TRANSCODER_MAX_WORKERS or os.cpu_count() or 1
+        self.max_queue: int = max_queue if max_queue is not None else config.TRANSCODER_MAX_QUEUE
+        self.job_timeout: float = job_timeout or config.TRANSCODER_JOB_TIMEOUT
+
+        self._executor: ProcessPoolExecutor = None  # type: ignore
+        self._pending: int = 0
+
+    @property
+    def pending(self) -> int:
+        """Jobs that are either running or waiting for a free worker."""
+        return self._pending
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs waiting for a free worker."""
+        return max(0, self._pending - self.max_workers)
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # forking the running bot would copy its threads' locks (held ones included) into the workers
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+        return self._executor
+
+    def _job_done(self, _: Future):
+        self._pending -= 1
+
+    async def submit(self, func: Callable, *args: Any) -> Any:
+        if self._pending >= self.capacity:
+            raise TranscoderSaturated(
+                f"Transcoder is busy ({self.queue_depth} jobs queued), try again in a few seconds."
+            )
+
+        loop = asyncio.get_running_loop()
+
+        executor = self._get_executor()
+
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise TranscoderCrashed("The emote processor crashed, try again.")
+
+        self._pending += 1
+        # Counter is decremented when the job actually finishes in the worker, not when we stop waiting on it,
+        # so timed out jobs still occupy their slot until they are done.
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._job_done, f))
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.job_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Transcode job {func.__name__} timed out after {self.job_timeout}s")
+            raise TranscodeTimeout(f"Processing the emote took longer than {self.job_timeout} seconds.")
+        except BrokenProcessPool:
+            logger.error(f"A transcoder worker died while running {func.__name__}, replacing the pool")
+            self._discard_executor(executor)
+            raise TranscoderCrashed("The emote processor crashed while working on this emote, try again.")
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        # several jobs fail at once when the pool breaks, only the first one replaces it
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,187 @@
+import time
+import random
+import asyncio
+import logging
+import aiohttp
+from yarl import URL
+
+import config
+from metrics import http_breaker_open
+from api.errors import SevenTVUnavailable
+
+logger = logging.getLogger(__name__)
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a host after too many consecutive failures.
+    After `reset_timeout` seconds one trial request is let through (half-open), its result closes or re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+
+        self.failures: int = 0
+        self.opened_at: float | None = None
+        self._trial_in_flight: bool = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+
+        return self.OPEN
+
+    def allow_request(self) -> bool:
+        match self.state:
+            case self.CLOSED:
+                return True
+
+            case self.HALF_OPEN if not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def release_trial(self):
+        """Lets another trial request through, for when the last one ended without telling anything about the host."""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+
+
+class Transport:
+    """
+    Pooled HTTP client for 7TV with timeouts, jittered retries on 5xx/429 (honoring Retry-After)
+    and a circuit breaker per host.
+    """
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession = None  # type: ignore
+        self._connector: aiohttp.TCPConnector = None  # type: ignore
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+        self.retries: int = 0
+
+    async def start(self):
+        self._connector = aiohttp.TCPConnector(
+            limit=config.HTTP_POOL_LIMIT,
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_TTL
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=aiohttp.ClientTimeout(
+                connect=config.HTTP_CONNECT_TIMEOUT, sock_read=config.HTTP_READ_TIMEOUT
+            )
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def breaker_for(self, host: str) -> CircuitBreaker:
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker(
+                config.HTTP_BREAKER_FAILURE_THRESHOLD, config.HTTP_BREAKER_RESET_TIMEOUT
+            )
+            breaker = self._breakers[host]
+            http_breaker_open.set_function(lambda: int(breaker.state != CircuitBreaker.CLOSED), host=host)
+
+        return self._breakers[host]
+
+    @staticmethod
+    def _retry_delay(attempt: int, response: aiohttp.ClientResponse | None = None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), config.HTTP_RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+
+        # full jitter exponential backoff
+        return random.uniform(0, min(config.HTTP_RETRY_BACKOFF * 2 ** attempt, config.HTTP_RETRY_MAX_DELAY))
+
+    async def request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """Returned response has to be released by the caller (`async with response:` or reading the body)."""
+        host = URL(url).host
+        breaker = self.breaker_for(host)
+
+        for attempt in range(config.HTTP_RETRIES + 1):
+            trial = breaker.state == breaker.HALF_OPEN
+            if not breaker.allow_request():
+                raise SevenTVUnavailable(f"{host} is unavailable, not sending requests to it for a while.")
+
+            last_attempt = attempt >= config.HTTP_RETRIES
+
+            try:
+                response = await self._session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+
+                if last_attempt:
+                    raise SevenTVUnavailable(f"Failed to reach {host}: {e!r}")
+
+                delay = self._retry_delay(attempt)
+            except BaseException:
+                # cancelled, invalid URL and such, not the host's fault, but a half-open trial must not stay taken
+                if trial:
+                    breaker.release_trial()
+                raise
+            else:
+                if response.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+
+                if response.status not in _RETRY_STATUSES or last_attempt:
+                    return response
+
+                delay = self._retry_delay(attempt, response)
+                response.release()
+
+            self.retries += 1
+            logger.debug(f"Retrying {method} {url} in {delay:.2f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        return await self.request("GET", url, **kwargs)
+
+    def stats(self) -> dict:
+        connector = self._connector
+
+        return {
+            "pool": {
+                "limit": connector.limit if connector else None,
+                "limit_per_host": connector.limit_per_host if connector else None,
+                "acquired": len(connector._acquired) if connector else 0,  # noqa, no public API for this
+            },
+            "retries": self.retries,
+            "breakers": {
+                host: {"state": breaker.state, "failures": breaker.failures} for host, breaker in self._breakers.items()
+            }
+        }
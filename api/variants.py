@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+
+from PIL import Image
+
+import config
+
+
+@dataclass
+class VariantPlan:
+    file: dict
+    format: str
+    predicted_size: float
+    max_side: int | None = None  # downscale locally so the bigger side is at most this, None to keep as is
+
+    @property
+    def name(self) -> str:
+        return self.file.get("name")
+
+    @property
+    def key(self) -> str:
+        """Identifies the planned output, f.e `3x.webp` or `4x.webp@96` when downscaled."""
+        return self.name if self.max_side is None else f"{self.name}@{self.max_side}"
+
+    @property
+    def output_size(self) -> tuple[int, int]:
+        width, height = int(self.file.get("width")), int(self.file.get("height"))
+
+        if self.max_side is None or max(width, height) <= self.max_side:
+            return width, height
+
+        scale = self.max_side / max(width, height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _file_format(file: dict) -> str:
+    file_format = file.get("format")
+    if file_format:
+        return file_format.upper()
+
+    return file.get("name", "").rsplit(".", 1)[-1].upper()
+
+
+def _biggest_side(file: dict) -> int:
+    return max(int(file.get("width")), int(file.get("height")))
+
+
+def _decodable_formats() -> set[str]:
+    return set(Image.registered_extensions().values())
+
+
+def _predict_size(file: dict, file_format: str, max_side: int | None = None) -> float:
+    """
+    Rough size of the file after transcoding to GIF/PNG.
+    Modern formats compress a lot better than what we output, so their size is scaled up by a per-format ratio.
+    """
+    predicted = file.get("size", 0) * config.VARIANT_OUTPUT_SIZE_RATIOS.get(file_format, 1.0)
+
+    biggest_side = _biggest_side(file)
+    if max_side is not None and biggest_side > max_side:
+        predicted *= (max_side / biggest_side) ** 2
+
+    return predicted
+
+
+def plan_variant(files: list[dict], animated: bool) -> VariantPlan | None:
+    """
+    Picks which of 7TV's files to download.
+
+    Of all variants predicted to fit under the emoji size limit as is, the cheapest download that is still
+    big enough to be displayed sharply wins. Otherwise the cheapest sharp download is planned with a local downscale,
+    using the biggest step of the resize ladder predicted to fit, unless a smaller variant fits at a bigger size.
+    """
+    decodable = _decodable_formats()
+    candidates: list[tuple[dict, str]] = []
+
+    for file in files:
+        file_format = _file_format(file)
+
+        if file_format not in decodable:
+            continue
+
+        # 7TV's PNGs of animated emotes only contain the first frame
+        if animated and file_format == "PNG":
+            continue
+
+        if not file.get("size") or not file.get("width") or not file.get("height"):
+            continue
+
+        candidates.append((file, file_format))
+
+    if not candidates:
+        return None
+
+    fitting = [
+        VariantPlan(file, file_format, _predict_size(file, file_format))
+        for file, file_format in candidates
+        if _predict_size(file, file_format) < config.EMOJI_SIZE_LIMIT
+    ]
+
+    sharp = [plan for plan in fitting if _biggest_side(plan.file) >= config.EMOJI_DISPLAY_SIZE]
+    if sharp:
+        return min(sharp, key=lambda plan: plan.file.get("size"))
+
+    # Nothing sharp fits as is, a local downscale of the cheapest sharp download may still beat a tiny variant
+    sharp_candidates = [
+        (file, file_format) for file, file_format in candidates if _biggest_side(file) >= config.EMOJI_DISPLAY_SIZE
+    ] or candidates
+    file, file_format = min(sharp_candidates, key=lambda candidate: candidate[0].get("size"))
+
+    downscaled = None
+    for max_side in config.DOWNSCALE_LADDER:
+        if max_side >= _biggest_side(file):
+            continue
+
+        predicted = _predict_size(file, file_format, max_side)
+        if predicted < config.EMOJI_SIZE_LIMIT:
+            downscaled = VariantPlan(file, file_format, predicted, max_side)
+            break
+
+    best_fitting = max(
+        fitting, key=lambda plan: (_biggest_side(plan.file), -plan.file.get("size")), default=None
+    )
+
+    if downscaled and (best_fitting is None or downscaled.max_side > _biggest_side(best_fitting.file)):
+        return downscaled
+
+    if best_fitting:
+        return best_fitting
+
+    # Even the smallest step isn't predicted to fit, try it anyway, the transcoder has its own levers left
+    max_side = config.DOWNSCALE_LADDER[-1]
+    return VariantPlan(file, file_format, _predict_size(file, file_format, max_side), max_side)
@@ -0,0 +1,268 @@
+"""
+Benchmarks the emote transcoder (`api/image.py`) on a generated corpus, no network needed.
+
+Every (corpus case, strategy) pair runs in a fresh process, so peak RSS isn't polluted by previous runs.
+
+    python -m benchmarks.image_bench --output before.json
+    python -m benchmarks.image_bench --output after.json --compare before.json
+"""
+import io
+import sys
+import math
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+import PIL
+from PIL import Image, ImageDraw
+
+import config
+from api import image as image_module
+
+
+@dataclass
+class Case:
+    name: str
+    kind: str  # gif or png
+    width: int
+    height: int
+    frames: int = 1
+    transparent: bool = False
+    noisy: bool = False  # random noise per frame (compresses badly) instead of moving shapes
+    holds: int = 1  # shapes only move every Nth frame, frames in between differ by a few stray pixels
+
+
+CORPUS: list[Case] = [
+    Case("png-128-opaque", "png", 128, 128),
+    Case("png-512-alpha", "png", 512, 512, transparent=True),
+    Case("png-384x128-alpha", "png", 384, 128, transparent=True),
+    Case("gif-128-24f", "gif", 128, 128, frames=24),
+    Case("gif-128-24f-alpha", "gif", 128, 128, frames=24, transparent=True),
+    Case("gif-128-120f-noisy", "gif", 128, 128, frames=120, noisy=True),
+    Case("gif-256-60f-alpha", "gif", 256, 256, frames=60, transparent=True),
+    Case("gif-384x128-90f", "gif", 384, 128, frames=90),
+    Case("gif-128-120f-holds", "gif", 128, 128, frames=120, holds=4),
+    Case("gif-128-300f-noisy", "gif", 128, 128, frames=300, noisy=True),
+    Case("gif-256-300f", "gif", 256, 256, frames=300),
+]
+
+
+def _draw_frame(case: Case, index: int, rng: random.Random) -> Image.Image:
+    mode = "RGBA" if case.transparent else "RGB"
+    background = (0, 0, 0, 0) if case.transparent else (32, 32, 48)
+
+    if case.noisy:
+        frame = Image.frombytes("RGB", (case.width, case.height), rng.randbytes(case.width * case.height * 3))
+        frame = frame.convert(mode)
+    else:
+        frame = Image.new(mode, (case.width, case.height), background)
+
+    draw = ImageDraw.Draw(frame)
+    for shape in range(6):
+        phase = (index // case.holds * case.holds / max(case.frames, 1) + shape / 6) * 2 * math.pi
+        x = case.width / 2 + case.width / 3 * math.cos(phase)
+        y = case.height / 2 + case.height / 3 * math.sin(phase * (shape % 3 + 1))
+        radius = min(case.width, case.height) / 8
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=(40 * shape, 255 - 30 * shape, 120, 255))
+
+    if case.holds > 1:
+        # otherwise Pillow merges the held frames into one already when generating
+        for _ in range(3):
+            frame.putpixel((rng.randrange(case.width), rng.randrange(case.height)), (255, 255, 255, 255))
+
+    return frame
+
+
+def generate(case: Case, seed: int = 0) -> bytes:
+    rng = random.Random(f"{seed}:{case.name}")
+    frames = [_draw_frame(case, index, rng) for index in range(case.frames)]
+    output = io.BytesIO()
+
+    if case.kind == "png":
+        frames[0].save(output, format="PNG")
+    else:
+        frames[0].save(
+            output, format="GIF", save_all=True, append_images=frames[1:], duration=50, loop=0,
+            disposal=2 if case.transparent else 1
+        )
+
+    return output.getvalue()
+
+
+def _no_prediction(data: bytes) -> bytes:
+    """
+    Tries every compress factor in order at full size until one fits, no size predictions or downscaling.
+    Encodes with today's `process_gif`, so it shows what the predictions save, not how the original transcoder did.
+    """
+    image = Image.open(io.BytesIO(data))
+
+    if image.format != "GIF" and not getattr(image, "is_animated", False):
+        return image_module.format_emote_for_discord(data)
+
+    result = b""
+    for compress_factor in range(1, config.GIF_MAX_COMPRESS_FACTOR + 1):
+        result = image_module.process_gif(image, compress_factor=compress_factor)
+        if len(result) < config.EMOJI_SIZE_LIMIT:
+            break
+
+    return result
+
+
+def _per_frame_palette(data: bytes) -> bytes:
+    """Lets Pillow quantize every frame on its own instead of mapping them onto a shared palette."""
+    config.GIF_SHARED_PALETTE = False  # every run has its own process, nothing else sees this
+    return image_module.format_emote_for_discord(data)
+
+
+STRATEGIES: dict[str, Callable[[bytes], bytes]] = {
+    "default": image_module.format_emote_for_discord,
+    "per-frame-palette": _per_frame_palette,
+    "fit-to-square": lambda data: image_module.format_emote_for_discord(data, fit_to_square=True),
+    "no-prediction": _no_prediction,
+}
+
+
+def _peak_rss_kib() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS, KiB elsewhere
+
+
+def _run(case: Case, strategy: str, data: bytes) -> dict:
+    baseline_rss = _peak_rss_kib()
+
+    # every full or trial (size estimate) encode goes through _encode_gif_frames, count them
+    passes = {"encode_passes": 0, "encoded_frames": 0}
+    encode = image_module._encode_gif_frames  # noqa
+
+    def counting_encode(image, frame_indexes, *args, **kwargs):
+        passes["encode_passes"] += 1
+        passes["encoded_frames"] += len(frame_indexes)
+        return encode(image, frame_indexes, *args, **kwargs)
+
+    image_module._encode_gif_frames = counting_encode
+
+    started_at = time.perf_counter()
+    result = STRATEGIES[strategy](data)
+    wall_time = time.perf_counter() - started_at
+    output = Image.open(io.BytesIO(result))
+
+    return {
+        "case": case.name,
+        "strategy": strategy,
+        "input_size": len(data),
+        "wall_time": round(wall_time, 4),
+        "peak_rss_kib": _peak_rss_kib(),
+        "peak_rss_growth_kib": _peak_rss_kib() - baseline_rss,
+        "output_size": len(result),
+        "size_limit": config.EMOJI_SIZE_LIMIT,
+        "size_ratio": round(len(result) / config.EMOJI_SIZE_LIMIT, 4),
+        "fits": len(result) < config.EMOJI_SIZE_LIMIT,
+        # which level the output ended up at, output sizes of different levels aren't comparable
+        "output_width": output.width,
+        "output_height": output.height,
+        "output_frames": getattr(output, "n_frames", 1),
+        **passes,
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cases: list[Case], strategies: list[str], repeat: int = 1, seed: int = 0) -> dict:
+    results = []
+    # Linux keeps the peak RSS of the parent in forked and even exec'd children, so the parent must stay small:
+    # everything, generating the corpus included, runs in fresh processes.
+    context = multiprocessing.get_context("spawn")
+
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            data = executor.submit(generate, case, seed).result()
+
+        for strategy in strategies:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    runs.append(executor.submit(_run, case, strategy, data).result())
+
+            result = min(runs, key=lambda r: r["wall_time"])
+            result["wall_time_runs"] = [r["wall_time"] for r in runs]
+            results.append(result)
+
+            print(
+                f"{case.name:<24} {strategy:<18} {result['wall_time']:>8.3f}s {result['peak_rss_kib'] / 1024:>8.1f}MB "
+                f"{result['output_size'] / 1024:>8.1f}KB {'fits' if result['fits'] else 'TOO BIG':<7} "
+                f"{result['output_width']}x{result['output_height']}x{result['output_frames']:<4} "
+                f"{result['encode_passes']} passes",
+                file=sys.stderr
+            )
+
+    return {
+        "revision": _git_revision(),
+        "encoder_version": image_module.ENCODER_VERSION,
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "seed": seed,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict):
+    """Prints the relative change of every metric between two result files."""
+    old_results = {(r["case"], r["strategy"]): r for r in before["results"]}
+    print(f"{before.get('revision')} -> {after.get('revision')}", file=sys.stderr)
+
+    for result in after["results"]:
+        old = old_results.get((result["case"], result["strategy"]))
+        if old is None:
+            continue
+
+        changes = []
+        for metric in ("wall_time", "peak_rss_kib", "output_size", "encode_passes"):
+            if old[metric]:
+                changes.append(f"{metric} {(result[metric] - old[metric]) / old[metric]:+.1%}")
+
+        if old["fits"] != result["fits"]:
+            changes.append("now fits" if result["fits"] else "NO LONGER FITS")
+
+        print(f"{result['case']:<24} {result['strategy']:<18} " + ", ".join(changes), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    parser.add_argument("--strategy", action="append", choices=list(STRATEGIES), help="default: all")
+    parser.add_argument("--case", action="append", choices=[case.name for case in CORPUS], help="default: all")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest one is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cases = [case for case in CORPUS if not args.case or case.name in args.case]
+    results = run(cases, args.strategy or list(STRATEGIES), repeat=args.repeat, seed=args.seed)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
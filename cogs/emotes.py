@@ -1,21 +1,73 @@
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
 from typing import Sequence
 
 import discord
 from aiohttp.helpers import method_must_be_empty_body
 from discord import SlashCommandGroup
-from discord.ext.commands import bot_has_permissions
-
-from api import api_instance
+from discord.ext import tasks
+from discord.ext.commands import bot_has_permissions, is_owner
+
+import config
+import metrics
+from api import api_instance, Emote
+from api.image import ENCODER_VERSION
+from api.variants import VariantPlan
+from emoji_index import emoji_indexes
+from loop_watchdog import loop_watchdog
 from ctx import SubApplicationContext
 from helpers import send_missing_custom_permissions_message, to_discord_emoji_name, emote_list_autocomplete, \
     ConfirmationView
 from models import GuildSettings
+from pipeline import Pipeline, Stage
+from reconcile import reconcile_deleted_emotes
+from uploads import upload_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SetImportItem:
+    seventv_id: str
+    name: str
+    emote_json: dict | None = None
+
+    plan: VariantPlan | None = None
+    source_url: str | None = None
+    source_bytes: bytes | None = None
+    emote: Emote | None = None
+    discord_emote: discord.Emoji | None = None
+    error: str | None = None
 
 
 class EmotesCog(discord.Cog):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
 
+        # guild id -> IDs of removed emojis waiting to be written, since when, and the task that'll write them
+        self._pending_removals: dict[int, set[int]] = {}
+        self._pending_since: dict[int, float] = {}
+        self._flush_tasks: dict[int, asyncio.Task] = {}
+
+    def cog_unload(self):
+        self.reconcile_loop.cancel()
+
+    @tasks.loop(hours=config.RECONCILE_INTERVAL_HOURS)
+    async def reconcile_loop(self):
+        try:
+            await reconcile_deleted_emotes(self.bot)
+        except Exception as e:
+            # an exception would end the loop for good, the next run just tries again
+            logger.exception("Reconciling deleted emotes failed", exc_info=e)
+
+    @discord.Cog.listener()
+    async def on_ready(self):
+        # runs right away on start, then periodically
+        if not self.reconcile_loop.is_running():
+            self.reconcile_loop.start()
+
     command_group_7tv = SlashCommandGroup('7tv', description="7TV Related Commands")
     command_subgroup_7tv_emote = command_group_7tv.create_subgroup('emote', description="7TV Emote Commands")
 
@@ -49,7 +101,8 @@ class EmotesCog(discord.Cog):
 
         emote_id = emote_url.split("/")[-1]
         try:
-            emote = await api_instance.emote_get(emote_id, fit_to_square, speed_up)
+            with metrics.imports_in_flight.track(kind="single"):
+                emote = await api_instance.emote_get(emote_id, fit_to_square, speed_up)
         except Exception as e:
             await self.bot.on_application_command_error(ctx, e)  # type: ignore
             return
@@ -85,11 +138,23 @@ class EmotesCog(discord.Cog):
             embed.description = "Cancelled."
             return await ctx.edit(embed=embed, view=view)
 
-        discord_emote = await ctx.guild.create_custom_emoji(
-            name=custom_name, image=emote.emote_bytes, roles=[limit_to_role] if limit_to_role else None,
-            reason=f'{ctx.author.name} ({ctx.author.id}) imported a 7TV Emote "{emote.name}" [{emote.id}]'
-        )
-        await ctx.guild_settings.register_emote(ctx.author, emote, discord_emote.id)
+        # not counted while waiting for the confirmation, only while actually being worked on
+        with metrics.imports_in_flight.track(kind="single"):
+            upload_job = upload_scheduler.submit(
+                ctx.guild, ctx.author.id,
+                name=custom_name, image=emote.emote_bytes, roles=[limit_to_role] if limit_to_role else None,
+                reason=f'{ctx.author.name} ({ctx.author.id}) imported a 7TV Emote "{emote.name}" [{emote.id}]'
+            )
+
+            position, eta = upload_scheduler.position(upload_job)
+            if position > 0 or eta > config.UPLOAD_DEFAULT_DURATION * 2:
+                view.disable_all_items()
+                embed.description = f":hourglass: Waiting for upload, **#{position + 1}** in queue (~{eta:.0f}s)"
+                await ctx.edit(embed=embed, view=view)
+
+            discord_emote = await upload_job.wait()
+            await ctx.guild_settings.register_emote(ctx.author, emote, discord_emote.id)
+        emoji_indexes.mark_imported(ctx.guild.id, discord_emote.id)
 
         final_response = f":white_check_mark: Successfully created {discord_emote}"
 
@@ -108,6 +173,190 @@ class EmotesCog(discord.Cog):
         await message.delete()
         await ctx.send(content=ctx.author.mention, embed=embed)
 
+    @command_subgroup_7tv_emote.command(
+        name="add-set", description="Import every emote of a 7TV emote set."
+    )
+    @bot_has_permissions(manage_emojis=True)
+    async def emote_add_set(
+            self, ctx: SubApplicationContext,
+            set_url: discord.Option(str, name='url', description='Direct 7TV Emote Set URL'),
+            fit_to_square: discord.Option(
+                bool, description="Makes the emotes fit Square 1:1 Aspect Ratio",
+            ),
+            speed_up: discord.Option(
+                bool, description="Wether or not to bother slowing down the GIFs if frames were skipped "
+                                  "(effectively speeding them up)",
+            ) = False
+    ):
+        if not await ctx.guild_settings.check_custom_permissions(ctx):
+            return await send_missing_custom_permissions_message(ctx)
+
+        await ctx.defer(ephemeral=True)
+
+        set_id = set_url.split("/")[-1]
+        try:
+            emote_set = await api_instance.emote_set_get(set_id)
+        except Exception as e:
+            await self.bot.on_application_command_error(ctx, e)  # type: ignore
+            return
+
+        registered_ids = await ctx.guild_settings.seventv_ids()
+        free_slots = {
+            animated: ctx.guild.emoji_limit - len([emoji for emoji in ctx.guild.emojis if emoji.animated == animated])
+            for animated in (False, True)
+        }
+
+        items: list[SetImportItem] = []
+        skipped_registered = skipped_no_slots = 0
+
+        for set_emote in emote_set.get("emotes") or []:
+            if set_emote.get("id") in registered_ids:
+                skipped_registered += 1
+                continue
+
+            emote_json = set_emote.get("data")
+            animated = bool(emote_json and emote_json.get("animated"))
+
+            if free_slots[animated] < 1:
+                skipped_no_slots += 1
+                continue
+
+            free_slots[animated] -= 1
+            items.append(SetImportItem(
+                seventv_id=set_emote.get("id"),
+                name=to_discord_emoji_name(set_emote.get("name", "")),
+                emote_json=emote_json
+            ))
+
+        embed = discord.Embed(
+            title=emote_set.get("name"),
+            description=f"**Are you sure you want to add {len(items)} emotes from this set?**",
+            color=discord.Color.embed_background()
+        )
+        embed.add_field(name='Fit to Square', value=":white_check_mark:" if fit_to_square else ":x:")
+
+        if skipped_registered:
+            embed.add_field(name='Already Added', value=f"{skipped_registered} (skipped)")
+
+        if skipped_no_slots:
+            embed.add_field(name='No Free Emoji Slots', value=f"{skipped_no_slots} (skipped)")
+
+        if not items:
+            embed.description = ":x: There are no emotes to add from this set."
+            return await ctx.respond(embed=embed, ephemeral=True)
+
+        view = ConfirmationView()
+        await ctx.respond(embed=embed, view=view, ephemeral=True)
+
+        await view.wait()
+
+        if not view.value:
+            view.disable_all_items()
+            embed.description = "Cancelled."
+            return await ctx.edit(embed=embed, view=view)
+
+        embed.clear_fields()
+        with metrics.imports_in_flight.track(kind="set"):
+            created = await self._run_set_import(ctx, items, embed, fit_to_square, speed_up)
+        failed = [item for item in items if item.error]
+
+        embed.description = (
+            f":white_check_mark: Successfully created {len(created)} emotes from **{emote_set.get('name')}**"
+        )
+        embed.clear_fields()
+
+        if created:
+            embed.add_field(name='Added', value=" ".join(str(item.discord_emote) for item in created)[:1024])
+
+        if failed:
+            embed.add_field(
+                name=f'Failed ({len(failed)})',
+                value="\n".join(f"`{item.name}`: {item.error}" for item in failed)[:1024], inline=False
+            )
+
+        try:
+            await ctx.edit(embed=embed, view=None)
+        except discord.HTTPException:
+            pass  # the interaction token expires after 15 minutes, the summary below still gets through
+
+        await ctx.send(content=ctx.author.mention, embed=embed)
+
+    async def _run_set_import(
+            self, ctx: SubApplicationContext, items: list[SetImportItem], embed: discord.Embed,
+            fit_to_square: bool, speed_up: bool
+    ) -> list[SetImportItem]:
+        async def fetch_metadata(item: SetImportItem) -> SetImportItem:
+            item.emote = await api_instance.transcode_cache.get(
+                item.seventv_id, fit_to_square, speed_up, ENCODER_VERSION
+            )
+
+            if not item.emote and not (item.emote_json and item.emote_json.get("host", {}).get("files")):
+                item.emote_json = await api_instance.emote_json_get(item.seventv_id)
+
+            return item
+
+        async def download(item: SetImportItem) -> SetImportItem:
+            if not item.emote:
+                item.plan, item.source_url, item.source_bytes = await api_instance.emote_download(item.emote_json)
+
+            return item
+
+        async def transcode(item: SetImportItem) -> SetImportItem:
+            if not item.emote:
+                item.emote = await api_instance.emote_transcode(
+                    item.emote_json, item.plan, item.source_url, item.source_bytes, fit_to_square, speed_up
+                )
+                item.source_bytes = None
+
+            return item
+
+        async def upload(item: SetImportItem) -> SetImportItem:
+            item.discord_emote = await upload_scheduler.upload(
+                ctx.guild, ctx.author.id,
+                name=item.name, image=item.emote.emote_bytes,
+                reason=f'{ctx.author.name} ({ctx.author.id}) imported a 7TV Emote "{item.emote.name}" '
+                       f'[{item.emote.id}] from a set'
+            )
+            await ctx.guild_settings.register_emote(ctx.author, item.emote, item.discord_emote.id)
+            emoji_indexes.mark_imported(ctx.guild.id, item.discord_emote.id)
+
+            return item
+
+        def on_error(item: SetImportItem, stage: Stage, error: Exception):
+            item.error = f"{stage.name} failed ({type(error).__name__})"
+            metrics.count_error(error)
+
+        stages = [
+            Stage("metadata", fetch_metadata, config.SET_IMPORT_METADATA_CONCURRENCY),
+            Stage("download", download, config.SET_IMPORT_DOWNLOAD_CONCURRENCY),
+            Stage("transcode", transcode, api_instance.transcoder.max_workers),
+            Stage("upload", upload, 1),
+        ]
+
+        last_progress_update = time.monotonic()
+
+        async def on_progress():
+            nonlocal last_progress_update
+
+            if time.monotonic() - last_progress_update < config.SET_IMPORT_PROGRESS_INTERVAL:
+                return
+
+            last_progress_update = time.monotonic()
+            embed.description = f":hourglass: Importing {len(items)} emotes...\n" + "\n".join(
+                f"`{stage.name}`: {stage.processed}/{len(items)}"
+                + (f" ({stage.failed} failed)" if stage.failed else "")
+                for stage in stages
+            )
+
+            try:
+                await ctx.edit(embed=embed, view=None)
+            except discord.HTTPException:
+                pass
+
+        pipeline = Pipeline(stages, config.SET_IMPORT_QUEUE_SIZE, on_error=on_error, on_progress=on_progress)
+
+        return await pipeline.run(items)
+
     @command_subgroup_7tv_emote.command(
         name="remove", description="Remove a 7TV emote if it was added by you (or you are an admin)"
     )
@@ -226,19 +475,115 @@ class EmotesCog(discord.Cog):
 
         await ctx.respond(embed=embed, ephemeral=True)
 
+    @command_group_7tv.command(name="stats", description="Import timings and error counts since the bot started.")
+    @is_owner()
+    async def stats(self, ctx: SubApplicationContext):
+        embed = discord.Embed(title="Stats", color=discord.Color.embed_background())
+
+        timings = []
+        for histogram in metrics.registry.metrics.values():
+            if not isinstance(histogram, metrics.Histogram):
+                continue
+
+            for key, series in histogram.series.items():
+                if not series.count:
+                    continue
+
+                labels = dict(zip(histogram.labelnames, key))
+                p50, p95 = histogram.quantile(0.5, **labels), histogram.quantile(0.95, **labels)
+                timings.append(
+                    f"`{' '.join([histogram.name, *key])}` {series.count}x, "
+                    f"avg {series.sum / series.count:.3f}s, p50 {p50:.3f}s, p95 {p95:.3f}s"
+                )
+
+        embed.description = "\n".join(timings)[:4096] or "Nothing measured yet."
+
+        errors = [f"`{key[0]}`: {value:.0f}" for key, value in metrics.errors_total.values.items() if value]
+        embed.add_field(name="Errors", value="\n".join(errors)[:1024] or "None", inline=False)
+
+        in_flight = [f"`{key[0]}`: {value:.0f}" for key, value in metrics.imports_in_flight.values.items()]
+        embed.add_field(name="Imports In Flight", value="\n".join(in_flight) or "None", inline=False)
+
+        embed.add_field(
+            name="Transcoder",
+            value=f"{metrics.transcoder_jobs.get(state='running'):.0f} running, "
+                  f"{metrics.transcoder_jobs.get(state='queued'):.0f} queued",
+            inline=False
+        )
+
+        cache_events = metrics.transcode_cache_events_total
+        embed.add_field(
+            name="Transcode Cache",
+            value=f"{cache_events.get(event='hit'):.0f} hits, {cache_events.get(event='miss'):.0f} misses, "
+                  f"{cache_events.get(event='eviction'):.0f} evictions, "
+                  f"{metrics.transcode_cache_bytes.get() / 1024 / 1024:.1f}MB",
+            inline=False
+        )
+
+        transport = api_instance.transport_stats()
+        breakers = [
+            f"`{host}`: {breaker['state']} ({breaker['failures']} failures)"
+            for host, breaker in transport["breakers"].items() if breaker["state"] != "closed"
+        ]
+        embed.add_field(
+            name="7TV HTTP",
+            value="\n".join([
+                f"{transport['pool']['acquired']}/{transport['pool']['limit']} connections in use, "
+                f"{transport['retries']} retries",
+                *breakers
+            ])[:1024],
+            inline=False
+        )
+
+        p50, p95, p99, worst = loop_watchdog.percentiles(0.5, 0.95, 0.99, 1)
+        if p50 is not None:
+            embed.add_field(
+                name="Event Loop Lag",
+                value=f"p50 {p50 * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms, "
+                      f"max {worst * 1000:.1f}ms, {loop_watchdog.stalls} stalls",
+                inline=False
+            )
+
+        await ctx.respond(embed=embed, ephemeral=True)
+
     @discord.Cog.listener()
     async def on_guild_emojis_update(
             self, guild: discord.Guild, before: Sequence[discord.Emoji], after: Sequence[discord.Emoji]
     ):
-        removed_emotes: list[discord.Emoji] = list(set(before) - set(after))
+        emoji_indexes.update(guild, before, after)
 
-        if len(removed_emotes) < 1:
+        removed_ids = {emoji.id for emoji in before} - {emoji.id for emoji in after}
+
+        if not removed_ids:
             return
 
-        guild_settngs, _ = await GuildSettings.get_or_create(guild_id=guild.id)
+        # bursts of updates (f.e mass deleting) are collected and written once things calm down,
+        # anything lost on shutdown is picked up by the reconcile loop on the next start
+        pending = self._pending_removals.setdefault(guild.id, set())
+        pending.update(removed_ids)
+
+        if guild.id not in self._pending_since:
+            self._pending_since[guild.id] = time.monotonic()
+
+        flush_task = self._flush_tasks.get(guild.id)
+        if flush_task and not flush_task.done():
+            flush_task.cancel()
+
+        delay = min(
+            config.EMOJI_UPDATE_DEBOUNCE,
+            max(0.0, self._pending_since[guild.id] + config.EMOJI_UPDATE_MAX_DELAY - time.monotonic())
+        )
+        self._flush_tasks[guild.id] = asyncio.create_task(self._flush_removals(guild.id, delay))
+
+    async def _flush_removals(self, guild_id: int, delay: float):
+        await asyncio.sleep(delay)
+
+        removed_ids = self._pending_removals.pop(guild_id, set())
+        self._pending_since.pop(guild_id, None)
+        self._flush_tasks.pop(guild_id, None)
 
-        for emote in removed_emotes:
-            await guild_settngs.remove_emote(emote_id=emote.id)
+        guild_settings, _ = await GuildSettings.get_or_create_cached(guild_id)
+        await guild_settings.remove_emotes(removed_ids)
 
 
 def setup(bot: discord.Bot):
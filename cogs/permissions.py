@@ -2,7 +2,8 @@ import discord
 from discord import SlashCommandGroup
 from discord.ext.commands import has_permissions
 from ctx import SubApplicationContext
-from helpers import commands_list_autocomplete, qualified_commands_list
+from helpers import commands_list_autocomplete, command_registry
+from models import guild_settings_cache
 
 
 class PermissionsCog(discord.Cog):
@@ -23,7 +24,7 @@ class PermissionsCog(discord.Cog):
                 autocomplete=commands_list_autocomplete
             )
     ):
-        if command not in qualified_commands_list():
+        if command not in command_registry:
             return await ctx.respond(f":x: There is no such command! `/{command}`", ephemeral=True)
 
         await ctx.defer(ephemeral=True)
@@ -45,7 +46,7 @@ class PermissionsCog(discord.Cog):
                 autocomplete=commands_list_autocomplete
             )
     ):
-        if command not in qualified_commands_list():
+        if command not in command_registry:
             return await ctx.respond(f":x: There is no such command! `/{command}`", ephemeral=True)
 
         await ctx.defer(ephemeral=True)
@@ -63,7 +64,7 @@ class PermissionsCog(discord.Cog):
                 autocomplete=commands_list_autocomplete
             )
     ):
-        if command not in qualified_commands_list():
+        if command not in command_registry:
             return await ctx.respond(f":x: There is no such command! `/{command}`", ephemeral=True)
 
         overrides = await ctx.guild_settings.get_command_permissions(command)
@@ -87,6 +88,21 @@ class PermissionsCog(discord.Cog):
 
         await ctx.respond(embed=embed)
 
+    @discord.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if before.permissions == after.permissions:
+            return
+
+        guild_settings = guild_settings_cache.get(after.guild.id)
+        if guild_settings:
+            guild_settings.invalidate_permission_decisions()
+
+    @discord.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        guild_settings = guild_settings_cache.get(role.guild.id)
+        if guild_settings:
+            guild_settings.invalidate_permission_decisions()
+
 
 def setup(bot: discord.Bot):
     bot.add_cog(PermissionsCog(bot))
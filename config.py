@@ -3,11 +3,79 @@ import logging
 SEVEN_TV_API_URL: str = "https://7tv.io"
 SEVEN_TV_API_VERSION: str = "v3"
 
+# HTTP transport used for 7TV's API and CDN
+HTTP_POOL_LIMIT: int = 100  # open connections overall
+HTTP_POOL_LIMIT_PER_HOST: int = 20
+HTTP_KEEPALIVE_TIMEOUT: float = 30  # in seconds
+HTTP_DNS_CACHE_TTL: int = 300  # in seconds
+HTTP_CONNECT_TIMEOUT: float = 5  # in seconds
+HTTP_READ_TIMEOUT: float = 15  # in seconds, between two reads
+HTTP_RETRIES: int = 3  # on connection errors, 5xx and 429
+HTTP_RETRY_BACKOFF: float = 0.5  # in seconds, doubled every attempt and jittered
+HTTP_RETRY_MAX_DELAY: float = 10  # in seconds, also caps Retry-After
+# Consecutive failures after which requests to the host fail fast, and for how long (in seconds)
+HTTP_BREAKER_FAILURE_THRESHOLD: int = 5
+HTTP_BREAKER_RESET_TIMEOUT: float = 30
+
 LOGGING_LEVEL = logging.INFO
 
+DATABASE_FILE: str = "bot.db"
+# Executed as `PRAGMA key=value` on every new SQLite connection
+SQLITE_PRAGMAS: dict[str, str | int] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # safe with WAL, only the last commits can be lost on power loss
+    "cache_size": -16000,  # negative is in KiB
+    "mmap_size": 64 * 1024 * 1024,  # in bytes
+    "busy_timeout": 5000,  # in ms
+    "foreign_keys": "ON",
+}
+# Group GuildSettings saves into one transaction every DB_WRITE_BEHIND_INTERVAL seconds instead of committing each.
+# Pending saves are flushed on shutdown.
+DB_WRITE_BEHIND: bool = True
+DB_WRITE_BEHIND_INTERVAL: float = 2
+
 # Discord emoji size limit, it *should* be 256kb
 EMOJI_SIZE_LIMIT: int = 262144  # in bytes
 
+# 7TV variants at least this big (in px, bigger side) look sharp as a Discord emoji, smaller ones are a last resort.
+EMOJI_DISPLAY_SIZE: int = 96
+# Expected output/input size ratio when transcoding a 7TV file of given format to GIF/PNG.
+VARIANT_OUTPUT_SIZE_RATIOS: dict[str, float] = {
+    "GIF": 1.0,
+    "PNG": 1.0,
+    "WEBP": 2.5,
+    "AVIF": 4.0
+}
+# Sides (in px) to locally downscale to, in order, when no 7TV variant fits the size limit as is,
+# or when the transcoded emote still doesn't fit.
+DOWNSCALE_LADDER: list[int] = [128, 112, 96, 64, 48, 32]
+# Name of the PIL.Image.Resampling filter used whenever emotes are resized.
+# Sharper filters (BICUBIC, LANCZOS) add halos around flat colours, GIFs of them come out 2-3x bigger.
+IMAGE_RESAMPLE_FILTER: str = "BOX"
+
+# Source files bigger than this are not downloaded from 7TV's CDN at all.
+EMOTE_DOWNLOAD_MAX_SIZE: int = 8 * 1024 * 1024  # in bytes
+EMOTE_DOWNLOAD_CHUNK_SIZE: int = 64 * 1024  # in bytes
+
+# GIFs are shrunk by merging their most similar frames until 1/N of the distinct ones are left, N goes up to this value.
+GIF_MAX_COMPRESS_FACTOR: int = 4
+# When the predicted GIF encode misses the size limit, the corrected second one aims under this share of the limit,
+# trial encodes of other sides can be off by a different amount. There's no third encode, it has to fit.
+GIF_CORRECTED_FIT_MARGIN: float = 0.9
+# Consecutive frames differing less than this (mean per channel, 0-255) are always merged, adding up their durations.
+GIF_FRAME_MERGE_THRESHOLD: float = 1.0
+# Amount of frames trial-encoded to predict the size of the whole GIF.
+GIF_SIZE_ESTIMATE_SAMPLE_FRAMES: int = 8
+# Map every frame of a GIF onto one palette built from a sample of them, instead of quantizing each frame.
+# Faster, and the GIF needs one global colour table instead of one per frame.
+GIF_SHARED_PALETTE: bool = True
+# Shared palette sizes, smaller ones are tried before dropping more frames to fit under EMOJI_SIZE_LIMIT.
+GIF_PALETTE_SIZES: list[int] = [256, 128, 64]
+GIF_PALETTE_SAMPLE_FRAMES: int = 8  # frames the shared palette is built from
+# Decoded (and resized) frames kept per transcode job to be reused by its encode passes, in bytes.
+# Frames past it are decoded again for every pass instead.
+TRANSCODE_MEMORY_BUDGET: int = 32 * 1024 * 1024
+
 # These commands cannot be assigned custom permissions. Discord-based (based on role and user perms) perms are used.
 IGNORED_COMMANDS_FOR_PERMISSIONS_OVERRIDES: list[str] = ["permissions remove", "permissions allow", "permissions list"]
 
@@ -15,15 +83,68 @@ IGNORED_COMMANDS_FOR_PERMISSIONS_OVERRIDES: list[str] = ["permissions remove", "
 # (p.s all the commands that are not in this list are defaulted to False)
 DEFAULT_PERMISSIONS: dict[str: bool] = {
     "7tv emote add": False,
+    "7tv emote add-set": False,
     "permissions list": True
 }
 
 # Should permission overrides be ignored if the user has administrator permissions.
 IGNORE_OVERRIDES_IF_ADMINISTRATOR: bool = True
 
+# Cached permission decisions per guild, (member, command) pairs.
+PERMISSION_DECISIONS_CACHE_SIZE: int = 2048
+
 DEFAULT_PERMISSIONS_VALUE_JSON = {
     "role": [],  # ID of the role
     "user": []  # same as above, but user
 }
 
+# Bulk emote set import, workers per pipeline stage and size of the queues between stages.
+# Transcoding uses as many workers as the transcoder has, uploads go one by one because of Discord's rate limits.
+SET_IMPORT_METADATA_CONCURRENCY: int = 4
+SET_IMPORT_DOWNLOAD_CONCURRENCY: int = 4
+SET_IMPORT_QUEUE_SIZE: int = 4
+SET_IMPORT_PROGRESS_INTERVAL: float = 3  # in seconds, between progress message edits
+
+# Emoji uploads are queued per guild. Waits longer than UPLOAD_MAX_WAIT (in seconds) fail instead.
+UPLOAD_MAX_WAIT: float = 600
+# Used for ETAs until the real value is learned from uploads
+UPLOAD_DEFAULT_DURATION: float = 1.5  # in seconds
+
+# Amount of guilds whose settings are kept in memory, least recently used ones are evicted.
+GUILD_SETTINGS_CACHE_SIZE: int = 1000
+
+# Removing records of imported emotes that were deleted while the bot was offline, on start and then periodically.
+RECONCILE_INTERVAL_HOURS: float = 6
+RECONCILE_CONCURRENCY: int = 8  # guilds checked at once
+
+# Emoji removals from gateway events are written after this many seconds without new ones (in seconds),
+# but never later than EMOJI_UPDATE_MAX_DELAY after the first one.
+EMOJI_UPDATE_DEBOUNCE: float = 2
+EMOJI_UPDATE_MAX_DELAY: float = 10
+
 COGS: list[str] = ["permissions", "emotes"]
+
+# Emote transcoding process pool. Workers default to the amount of CPU cores when set to None.
+TRANSCODER_MAX_WORKERS: int | None = None
+TRANSCODER_MAX_QUEUE: int = 16  # jobs waiting for a free worker, new jobs are rejected above that
+TRANSCODER_JOB_TIMEOUT: float = 30  # in seconds
+
+# On-disk cache of already transcoded emotes, least recently used ones are evicted above the size cap.
+TRANSCODE_CACHE_DIR: str = "cache/emotes"
+TRANSCODE_CACHE_MAX_SIZE: int = 512 * 1024 * 1024  # in bytes
+
+# In-memory cache of 7TV emote JSON, "not found" answers are cached separately so typos don't hit the API on retry.
+METADATA_CACHE_MAX_ENTRIES: int = 2048
+METADATA_CACHE_TTL: float = 600  # in seconds
+METADATA_CACHE_NOT_FOUND_TTL: float = 60  # in seconds
+
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics), not served when the port is None.
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int | None = 9108
+
+# Event loop watchdog, a heartbeat every LOOP_WATCHDOG_INTERVAL seconds measures how late the loop runs it.
+# Blocking it for longer than LOOP_LAG_THRESHOLD seconds logs the blocking stack and the command behind it.
+LOOP_WATCHDOG: bool = True
+LOOP_WATCHDOG_INTERVAL: float = 0.1
+LOOP_LAG_THRESHOLD: float = 0.25
+LOOP_LAG_WINDOW: int = 600  # heartbeats the lag percentiles are taken over
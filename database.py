@@ -1,12 +1,33 @@
 from tortoise import Tortoise
 
+import config
+from models import GuildSettings
+from write_behind import write_behind
+
 
 async def db_init():
     await Tortoise.init(
-        db_url="sqlite://bot.db",
-        modules={'models': ['models']}
+        config={
+            "connections": {
+                "default": {
+                    "engine": "tortoise.backends.sqlite",
+                    # every extra credential is executed as `PRAGMA key=value` on connect
+                    "credentials": {"file_path": config.DATABASE_FILE, **config.SQLITE_PRAGMAS}
+                }
+            },
+            "apps": {
+                "models": {"models": ["models"], "default_connection": "default"}
+            }
+        }
     )
 
     print("✔ Database initialised!")
 
     await Tortoise.generate_schemas(safe=True)
+
+    migrated = await GuildSettings.migrate_emotes_json()
+    if migrated:
+        print(f"✔ Migrated {migrated} emotes to the imported_emote table!")
+
+    if config.DB_WRITE_BEHIND:
+        write_behind.start()
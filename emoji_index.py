@@ -0,0 +1,171 @@
+import bisect
+from collections import defaultdict, Counter
+from typing import Sequence
+
+import discord
+
+from models import ImportedEmote
+
+_MAX_GRAM = 3
+
+
+def _grams(text: str, size: int) -> set[str]:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class GuildEmojiIndex:
+    """
+    Searchable emoji names of a single guild: prefix matches via a sorted name list, substring and fuzzy matches
+    via an n-gram index. Emojis imported through the bot are ranked above others.
+    """
+
+    def __init__(self, emojis: Sequence[discord.Emoji] = (), imported_ids: set[int] = frozenset()):
+        self.imported: set[int] = set(imported_ids)
+
+        self._names: dict[int, str] = {}  # emoji id -> name
+        self._sorted: list[tuple[str, int]] = []  # (lowercase name, emoji id)
+        self._grams: defaultdict[str, set[int]] = defaultdict(set)
+        self._default_choices: list[tuple[int, str]] | None = None
+
+        for emoji in emojis:
+            self.add(emoji.id, emoji.name)
+
+    def __len__(self):
+        return len(self._names)
+
+    def _index_grams(self, lower_name: str) -> set[str]:
+        return set().union(*(_grams(lower_name, size) for size in range(1, _MAX_GRAM + 1)))
+
+    def name_of(self, emoji_id: int) -> str | None:
+        return self._names.get(emoji_id)
+
+    def add(self, emoji_id: int, name: str):
+        """Adds a new emoji, or updates the name of an existing one."""
+        self._unindex(emoji_id)
+
+        lower_name = name.lower()
+        self._names[emoji_id] = name
+        bisect.insort(self._sorted, (lower_name, emoji_id))
+
+        for gram in self._index_grams(lower_name):
+            self._grams[gram].add(emoji_id)
+
+        self._default_choices = None
+
+    def remove(self, emoji_id: int):
+        self._unindex(emoji_id)
+        self.imported.discard(emoji_id)
+
+    def _unindex(self, emoji_id: int):
+        name = self._names.pop(emoji_id, None)
+        if name is None:
+            return
+
+        lower_name = name.lower()
+        index = bisect.bisect_left(self._sorted, (lower_name, emoji_id))
+        if index < len(self._sorted) and self._sorted[index] == (lower_name, emoji_id):
+            del self._sorted[index]
+
+        for gram in self._index_grams(lower_name):
+            self._grams[gram].discard(emoji_id)
+            if not self._grams[gram]:
+                del self._grams[gram]
+
+        self._default_choices = None
+
+    def mark_imported(self, emoji_id: int):
+        self.imported.add(emoji_id)
+        self._default_choices = None
+
+    def _rank(self, tier: int, emoji_id: int) -> tuple:
+        name = self._names[emoji_id]
+        return tier, emoji_id not in self.imported, len(name), name.lower()
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[int, str]]:
+        """:return: Up to `limit` (emoji id, name) pairs, best matches first."""
+        query = query.lower()
+
+        if not query:
+            if self._default_choices is None:
+                self._default_choices = [
+                    (emoji_id, self._names[emoji_id])
+                    for emoji_id in sorted(self._names, key=lambda x: self._rank(0, x))
+                ][:limit]
+
+            return self._default_choices[:limit]
+
+        ranked: dict[int, tuple] = {}
+
+        # prefix matches, straight from the sorted names
+        index = bisect.bisect_left(self._sorted, (query,))
+        while index < len(self._sorted) and self._sorted[index][0].startswith(query):
+            emoji_id = self._sorted[index][1]
+            ranked[emoji_id] = self._rank(0, emoji_id)
+            index += 1
+
+        # substring matches, names containing every n-gram of the query (and the query itself)
+        if len(query) <= _MAX_GRAM:
+            candidates = self._grams.get(query, set())
+        else:
+            gram_sets = [self._grams.get(gram, set()) for gram in _grams(query, _MAX_GRAM)]
+            candidates = set.intersection(*gram_sets) if all(gram_sets) else set()
+
+        for emoji_id in candidates:
+            if emoji_id not in ranked and query in self._names[emoji_id].lower():
+                ranked[emoji_id] = self._rank(1, emoji_id)
+
+        # fuzzy matches, names sharing most of the query's trigrams (typos, swapped letters)
+        if len(ranked) < limit and len(query) >= _MAX_GRAM:
+            query_grams = _grams(query, _MAX_GRAM)
+            shared = Counter(
+                emoji_id for gram in query_grams for emoji_id in self._grams.get(gram, ())
+            )
+
+            for emoji_id, count in shared.items():
+                if emoji_id not in ranked and count / len(query_grams) >= 0.5:
+                    ranked[emoji_id] = self._rank(2, emoji_id)
+
+        return [(emoji_id, self._names[emoji_id]) for emoji_id in sorted(ranked, key=ranked.get)[:limit]]
+
+
+class EmojiIndexes:
+    """GuildEmojiIndex per guild, built on first use and kept up to date from gateway emoji updates."""
+
+    def __init__(self):
+        self._indexes: dict[int, GuildEmojiIndex] = {}
+
+    async def get(self, guild: discord.Guild) -> GuildEmojiIndex:
+        index = self._indexes.get(guild.id)
+
+        if index is None:
+            imported_ids = set(await ImportedEmote.filter(guild_id=guild.id).values_list("discord_id", flat=True))
+            # another autocomplete could have built it while we were waiting for the DB
+            index = self._indexes.setdefault(guild.id, GuildEmojiIndex(guild.emojis, imported_ids))
+
+        return index
+
+    def update(self, guild: discord.Guild, before: Sequence[discord.Emoji], after: Sequence[discord.Emoji]):
+        index = self._indexes.get(guild.id)
+        if index is None:
+            return
+
+        after_names = {emoji.id: emoji.name for emoji in after}
+
+        for emoji in before:
+            if emoji.id not in after_names:
+                index.remove(emoji.id)
+
+        for emoji_id, name in after_names.items():
+            if index.name_of(emoji_id) != name:  # added or renamed
+                index.add(emoji_id, name)
+
+    def mark_imported(self, guild_id: int, emoji_id: int):
+        index = self._indexes.get(guild_id)
+        if index is not None:
+            index.mark_imported(emoji_id)
+
+    def invalidate(self, guild_id: int):
+        self._indexes.pop(guild_id, None)
+
+
+emoji_indexes = EmojiIndexes()
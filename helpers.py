@@ -5,6 +5,7 @@ from discord import SlashCommandGroup
 import config
 from ctx import SubApplicationContext
 from bot import bot
+from emoji_index import emoji_indexes
 
 
 class ConfirmationView(discord.ui.View):
@@ -29,7 +30,8 @@ class ConfirmationView(discord.ui.View):
 def qualified_commands_list() -> list[str]:
     available_commands: list[str] = []
 
-    for cmd_object in bot.application_commands:
+    # commands are only registered after being synced, before that they are pending
+    for cmd_object in bot.application_commands or bot.pending_application_commands:
         if not isinstance(cmd_object, SlashCommandGroup):
             available_commands.append(cmd_object.qualified_name)
             continue
@@ -45,25 +47,83 @@ def qualified_commands_list() -> list[str]:
     return available_commands
 
 
+class CommandRegistry:
+    """
+    Qualified names of all slash commands, built once instead of walking command groups on every call.
+    Has to be rebuilt whenever commands change (done after loading cogs and after syncing commands).
+    """
+
+    def __init__(self, autocomplete_limit: int = 25):
+        self.autocomplete_limit: int = autocomplete_limit
+
+        self.names: list[str] = []
+        self._names: frozenset[str] = frozenset()
+        # prefix trie of commands that can have permission overrides, every node keeps its best completions
+        self._trie: dict = {}
+        self._built: bool = False
+
+    def rebuild(self):
+        self.names = qualified_commands_list()
+        self._names = frozenset(self.names)
+
+        self._trie = {"": []}
+        overridable = [name for name in self.names if name not in config.IGNORED_COMMANDS_FOR_PERMISSIONS_OVERRIDES]
+
+        # shorter (less nested) commands first, they are more likely what the user is typing
+        for name in sorted(overridable, key=lambda x: (len(x), x)):
+            node = self._trie
+            self._add_completion(node, name)
+
+            for char in name:
+                node = node.setdefault(char, {"": []})
+                self._add_completion(node, name)
+
+        self._built = True
+
+    def _add_completion(self, node: dict, name: str):
+        if len(node[""]) < self.autocomplete_limit:
+            node[""].append(name)
+
+    def _ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def __contains__(self, name: str) -> bool:
+        self._ensure_built()
+        return name in self._names
+
+    def complete(self, prefix: str) -> list[str]:
+        self._ensure_built()
+        node = self._trie
+
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        return list(node[""])
+
+
+command_registry = CommandRegistry()
+
+
 def to_discord_emoji_name(name) -> str:
     name = name.replace(" ", "_").replace("-", "_")
-    name = re.sub(r"[^a-zA-Z0-9_]", "", name)
+    name = re.sub(r"[^a-zA-Z0-9_]", "", name)[:32]  # Discord wants 2 to 32 characters
 
-    return name if name else "emoji"
+    return name.ljust(2, "_") if name else "emoji"
 
 
 async def commands_list_autocomplete(ctx: discord.AutocompleteContext):
-    return [
-        cmd for cmd in qualified_commands_list()
-        if cmd not in config.IGNORED_COMMANDS_FOR_PERMISSIONS_OVERRIDES
-           and cmd.startswith(ctx.value)
-    ]
+    return command_registry.complete(ctx.value)
 
 
 async def emote_list_autocomplete(ctx: discord.AutocompleteContext):
+    index = await emoji_indexes.get(ctx.interaction.guild)
+
     return [
-        discord.OptionChoice(f"{emote.name} ({emote.id})", str(emote.id)) for emote in ctx.interaction.guild.emojis
-        if emote.name.lower().startswith(ctx.value.lower())
+        discord.OptionChoice(f"{emote_name} ({emote_id})", str(emote_id))
+        for emote_id, emote_name in index.search(ctx.value or "")
     ]
 
 
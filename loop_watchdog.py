@@ -0,0 +1,141 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import weakref
+from collections import deque
+from contextvars import ContextVar, Context
+
+import discord
+
+import config
+from metrics import event_loop_lag_seconds, event_loop_stalls_total
+
+logger = logging.getLogger(__name__)
+
+# (command, guild id) the current task works for, inherited by every task it creates
+_current_command: ContextVar[tuple[str, int | None] | None] = ContextVar("current_command", default=None)
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag with a heartbeat task. A separate thread watches the heartbeat, so while the loop is
+    blocked for longer than `threshold` it can still capture the stack of the blocking frame, and log it together
+    with the command (and guild) the blocking task was started by.
+    """
+
+    def __init__(self, interval: float, threshold: float, window: int):
+        self.interval: float = interval
+        self.threshold: float = threshold
+        self.lags: deque[float] = deque(maxlen=window)  # seconds, of the last `window` heartbeats
+        self.stalls: int = 0
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id: int | None = None
+        self._last_beat: float = 0  # time.monotonic(), written by the loop, read by the watching thread
+        self._origins: weakref.WeakKeyDictionary[asyncio.Task, tuple[str, int | None]] = weakref.WeakKeyDictionary()
+
+        self._previous_task_factory = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stopped: threading.Event = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+
+        self._previous_task_factory = self._loop.get_task_factory()
+        self._loop.set_task_factory(self._task_factory)
+
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._task is None:
+            return
+
+        self._stopped.set()
+        self._task.cancel()
+        self._task = None
+        self._loop.set_task_factory(self._previous_task_factory)
+
+    def attribute(self, ctx: discord.ApplicationContext):
+        """Marks the current task, and every task it creates from now on, as working for the command."""
+        origin = (ctx.command.qualified_name, ctx.guild_id)
+        _current_command.set(origin)
+
+        task = asyncio.current_task()
+        if task is not None:
+            self._origins[task] = origin
+
+    def _task_factory(self, loop: asyncio.AbstractEventLoop, coro, context: Context | None = None) -> asyncio.Task:
+        if self._previous_task_factory is not None:
+            task = self._previous_task_factory(loop, coro, **({"context": context} if context else {}))
+        else:
+            task = asyncio.Task(coro, loop=loop, context=context)
+
+        origin = context.run(_current_command.get) if context else _current_command.get()
+        if origin is not None:
+            self._origins[task] = origin
+
+        return task
+
+    async def _heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+            lag = max(0.0, time.monotonic() - self._last_beat - self.interval)
+            self.lags.append(lag)
+            event_loop_lag_seconds.observe(lag)
+
+            if lag >= self.threshold:
+                logger.warning(f"Event loop was blocked for {lag:.3f}s")
+
+    def _watch(self):
+        reported_beat = None
+
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+
+            # one report per stall, taken while it is still going on
+            if blocked >= self.threshold and beat != reported_beat:
+                reported_beat = beat
+                self._report(blocked)
+
+    def _report(self, blocked: float):
+        frame = sys._current_frames().get(self._loop_thread_id)  # noqa
+        stack = "".join(traceback.format_stack(frame)) if frame else "(not available)\n"
+
+        # asyncio.current_task() is only safe to call from the loop's own thread
+        task = asyncio.tasks._current_tasks.get(self._loop)  # noqa
+        command, guild_id = self._origins.get(task, (None, None)) if task is not None else (None, None)
+
+        self.stalls += 1
+        event_loop_stalls_total.inc(command=command or "")
+
+        origin = f"/{command} in guild {guild_id}" if command else f"task {task.get_name()}" if task else "a callback"
+        logger.warning(
+            f"Event loop blocked for {blocked:.3f}s so far by {origin}, blocking stack (most recent call last):\n"
+            f"{stack}"
+        )
+
+    def percentiles(self, *qs: float) -> list[float | None]:
+        """Lag percentiles (0-1) over the rolling window, None until the first heartbeat."""
+        lags = sorted(self.lags)
+        if not lags:
+            return [None] * len(qs)
+
+        return [lags[min(int(q * len(lags)), len(lags) - 1)] for q in qs]
+
+
+loop_watchdog = LoopWatchdog(config.LOOP_WATCHDOG_INTERVAL, config.LOOP_LAG_THRESHOLD, config.LOOP_LAG_WINDOW)
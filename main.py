@@ -4,18 +4,24 @@ import discord
 import logging
 from tortoise import connections
 from dotenv import load_dotenv
-from discord.ext.commands import MissingPermissions
+from discord.ext.commands import MissingPermissions, NotOwner
 
 load_dotenv()
 
 import config
+import api.errors
 from api.errors import *
 from database import db_init
-from models import GuildSettings
+from write_behind import write_behind
+from models import GuildSettings, guild_settings_cache
 from ctx import SubApplicationContext
-from helpers import send_error_response
+from helpers import send_error_response, command_registry
+from emoji_index import emoji_indexes
 from bot import bot
 from api import api_instance
+from uploads import EmojiUploadRateLimited
+from metrics import metrics_server, count_error, register_errors
+from loop_watchdog import loop_watchdog
 
 logging.basicConfig(level=config.LOGGING_LEVEL)
 
@@ -26,25 +32,54 @@ async def overall_check(ctx: SubApplicationContext):
         await ctx.bot.wait_until_ready()
 
     # User creation if not present
-    guild_settings, _ = await GuildSettings.get_or_create(guild_id=ctx.guild.id)
+    guild_settings, _ = await GuildSettings.get_or_create_cached(ctx.guild.id)
 
     ctx.guild_settings = guild_settings
 
     return True
 
 
+@bot.before_invoke
+async def attribute_to_command(ctx: SubApplicationContext):
+    # lets the loop watchdog tell which command is behind a blocked event loop
+    loop_watchdog.attribute(ctx)
+
+
+@bot.event
+async def on_connect():
+    # replaces py-cord's default handler, which only syncs commands
+    await bot.sync_commands()
+    command_registry.rebuild()
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    guild_settings_cache.invalidate(guild.id)
+    emoji_indexes.invalidate(guild.id)
+
+
 @bot.event
 async def on_application_command_error(ctx: SubApplicationContext, error):
+    count_error(error)
+
     if isinstance(error, MissingPermissions):
         return await send_error_response(
             ctx, error, f"Bot lacks permissions: `{error.missing_permissions}`"
         )
 
+    elif isinstance(error, NotOwner):
+        return await send_error_response(ctx, error, ":x: Only the bot's owner can use this command!")
+
     elif isinstance(error, EmoteNotFound):
         return await send_error_response(
             ctx, error, f":x: **Emote Not Found!**\nMake sure the URL you provided is correct!"
         )
 
+    elif isinstance(error, EmoteSetNotFound):
+        return await send_error_response(
+            ctx, error, f":x: **Emote Set Not Found!**\nMake sure the URL you provided is correct!"
+        )
+
     elif isinstance(error, EmoteBytesReadFail):
         return await send_error_response(
             ctx, error, custom_message=
@@ -58,6 +93,39 @@ async def on_application_command_error(ctx: SubApplicationContext, error):
                                        f"`{config.EMOJI_SIZE_LIMIT} bytes`"
         )
 
+    elif isinstance(error, EmoteDownloadTooLarge):
+        return await send_error_response(
+            ctx, error, custom_message=f":x: This emote's file is too big to be processed!\n"
+                                       f"Limit is `{config.EMOTE_DOWNLOAD_MAX_SIZE} bytes`"
+        )
+
+    elif isinstance(error, SevenTVUnavailable):
+        return await send_error_response(
+            ctx, error, custom_message=":x: 7TV seems to be unavailable right now, try again later!"
+        )
+
+    elif isinstance(error, TranscoderSaturated):
+        return await send_error_response(
+            ctx, error, custom_message=":hourglass: Too many emotes are being processed right now, "
+                                       "try again in a few seconds!"
+        )
+
+    elif isinstance(error, TranscodeTimeout):
+        return await send_error_response(
+            ctx, error, custom_message=":x: Processing this emote took too long, try with a smaller one."
+        )
+
+    elif isinstance(error, TranscoderCrashed):
+        return await send_error_response(
+            ctx, error, custom_message=":x: Something went wrong while processing this emote, try again!"
+        )
+
+    elif isinstance(error, EmojiUploadRateLimited):
+        return await send_error_response(
+            ctx, error, custom_message=f":hourglass: Discord doesn't allow adding more emojis to this server "
+                                       f"right now, try again in `{error.retry_after / 60:.0f}` minutes."
+        )
+
     elif isinstance(error, EmoteJSONReadFail):
         return await send_error_response(
             ctx, error, custom_message=":x: Failed to read JSON for this Emote, most likely Invalid URL!"
@@ -69,8 +137,15 @@ async def on_application_command_error(ctx: SubApplicationContext, error):
 
 
 async def main():
+    if config.LOOP_WATCHDOG:
+        loop_watchdog.start()
+
     await api_instance.create_session()
     await db_init()
+
+    if config.METRICS_PORT is not None:
+        await metrics_server.start()
+
     await bot.start(os.getenv("TOKEN"))
 
 
@@ -83,6 +158,9 @@ if __name__ == "__main__":
         except discord.ExtensionNotFound:
             print(f'!!! Failed to load extension {cog}')
 
+    command_registry.rebuild()
+    register_errors(api.errors)
+
     event_loop = asyncio.get_event_loop_policy().get_event_loop()
 
     try:
@@ -92,5 +170,10 @@ if __name__ == "__main__":
     finally:
         print("🛑 Shutting Down")
         event_loop.run_until_complete(bot.close())
+        event_loop.run_until_complete(write_behind.stop())
         event_loop.run_until_complete(connections.close_all(discard=True))
+        event_loop.run_until_complete(api_instance.close())
+        event_loop.run_until_complete(metrics_server.close())
+        loop_watchdog.stop()
+        api_instance.transcoder.shutdown()
         event_loop.stop()
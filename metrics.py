@@ -0,0 +1,282 @@
+import time
+import bisect
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Callable, Iterator, TypeVar
+
+from aiohttp import web
+
+import config
+
+_DEFAULT_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class _Metric:
+    type: str = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple[str, ...] = labelnames
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", *self.samples()
+        ])
+
+
+class _ValueMetric(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+        self.functions: dict[tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels: str):
+        """Reads the value from `function` whenever it's asked for, for values kept by other objects anyway."""
+        self.functions[self._key(labels)] = function
+
+    def get(self, **labels: str) -> float:
+        key = self._key(labels)
+        if key in self.functions:
+            return self.functions[key]()
+
+        return self.values.get(key, 0)
+
+    def samples(self) -> Iterator[str]:
+        for key in {**self.values, **self.functions}:
+            yield f"{self.name}{_format_labels(self._labels(key))} {self.get(**self._labels(key))}"
+
+
+class Counter(_ValueMetric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_ValueMetric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels: str):
+        """Counts the wrapped block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class _HistogramSeries:
+    def __init__(self, bucket_count: int):
+        self.buckets: list[int] = [0] * bucket_count  # not cumulative, the last one is +Inf
+        self.count: int = 0
+        self.sum: float = 0.0
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+            self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = _DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.bounds: tuple[float, ...] = tuple(sorted(buckets))
+        self.series: dict[tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _HistogramSeries(len(self.bounds) + 1)
+
+        series.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        series.count += 1
+        series.sum += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observes how long the wrapped block took, in seconds, whether it raised or not."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def quantile(self, q: float, **labels: str) -> float | None:
+        """Estimated from the buckets, interpolating linearly inside the one the quantile falls into."""
+        series = self.series.get(self._key(labels))
+        if series is None or not series.count:
+            return None
+
+        rank = q * series.count
+        seen = 0
+        for index, in_bucket in enumerate(series.buckets):
+            if in_bucket and seen + in_bucket >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                if index >= len(self.bounds):
+                    return lower  # past the biggest bound, nothing better to say
+                return lower + (self.bounds[index] - lower) * (rank - seen) / in_bucket
+            seen += in_bucket
+
+        return self.bounds[-1]
+
+    def samples(self) -> Iterator[str]:
+        for key, series in self.series.items():
+            labels = self._labels(key)
+            cumulative = 0
+
+            for bound, in_bucket in zip((*self.bounds, "+Inf"), series.buckets):
+                cumulative += in_bucket
+                yield f"{self.name}_bucket{_format_labels({**labels, 'le': str(bound)})} {cumulative}"
+
+            yield f"{self.name}_sum{_format_labels(labels)} {series.sum}"
+            yield f"{self.name}_count{_format_labels(labels)} {series.count}"
+
+
+_MetricT = TypeVar("_MetricT", bound=_Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _MetricT) -> _MetricT:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All metrics in Prometheus' text exposition format."""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+metadata_fetch_seconds: Histogram = registry.register(Histogram(
+    "seventv_metadata_fetch_seconds", "Time spent fetching emote metadata from 7TV's API."
+))
+cdn_download_seconds: Histogram = registry.register(Histogram(
+    "seventv_cdn_download_seconds", "Time spent downloading emote files from 7TV's CDN."
+))
+emote_get_seconds: Histogram = registry.register(Histogram(
+    "emote_get_seconds", "Time EmotesAPI.emote_get took, from cache lookup to transcoded emote."
+))
+transcode_seconds: Histogram = registry.register(Histogram(
+    "transcode_seconds", "Time a transcode job took, including waiting for a free worker."
+))
+transcode_pass_seconds: Histogram = registry.register(Histogram(
+    "transcode_pass_seconds", "Time a single encode pass took, per kind: trial or full GIF, static PNG.", ("kind",)
+))
+discord_upload_seconds: Histogram = registry.register(Histogram(
+    "discord_upload_seconds", "Time spent creating an emoji through Discord's API."
+))
+db_save_seconds: Histogram = registry.register(Histogram(
+    "db_save_seconds", "Time spent writing guild settings and imported emotes to the database.", ("operation",)
+))
+errors_total: Counter = registry.register(Counter(
+    "errors_total", "Errors raised while handling commands and imports, per exception class.", ("error",)
+))
+imports_in_flight: Gauge = registry.register(Gauge(
+    "imports_in_flight", "Emote imports currently being processed.", ("kind",)
+))
+
+transcoder_jobs: Gauge = registry.register(Gauge(
+    "transcoder_jobs", "Transcode jobs running in a worker or queued for one.", ("state",)
+))
+transcode_cache_events_total: Counter = registry.register(Counter(
+    "transcode_cache_events_total", "Lookups and evictions of the on-disk transcode cache.", ("event",)
+))
+transcode_cache_bytes: Gauge = registry.register(Gauge(
+    "transcode_cache_bytes", "Size of the emotes kept in the on-disk transcode cache."
+))
+http_retries_total: Counter = registry.register(Counter(
+    "seventv_http_retries_total", "Requests to 7TV retried after a connection error, 5xx or 429."
+))
+http_connections_acquired: Gauge = registry.register(Gauge(
+    "seventv_http_connections_acquired", "Connections to 7TV currently in use."
+))
+http_breaker_open: Gauge = registry.register(Gauge(
+    "seventv_http_breaker_open", "1 when the circuit breaker of the host is open or half-open, 0 when closed.",
+    ("host",)
+))
+event_loop_lag_seconds: Histogram = registry.register(Histogram(
+    "event_loop_lag_seconds", "How late the event loop ran the watchdog's heartbeat.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+))
+event_loop_stalls_total: Counter = registry.register(Counter(
+    "event_loop_stalls_total", "Times the event loop was blocked past LOOP_LAG_THRESHOLD, per command blocking it.",
+    ("command",)
+))
+
+
+def count_error(error: BaseException):
+    # py-cord wraps exceptions raised inside commands, count the actual one
+    error = getattr(error, "original", None) or error
+    errors_total.inc(error=type(error).__name__)
+
+
+def register_errors(module: ModuleType):
+    """Makes every exception class of the module show up in errors_total, even before it is first raised."""
+    for name, error in vars(module).items():
+        if isinstance(error, type) and issubclass(error, Exception):
+            errors_total.inc(0, error=name)
+
+
+class MetricsServer:
+    """Serves the registry on `/metrics` for Prometheus to scrape."""
+
+    def __init__(self, host: str, port: int):
+        self.host: str = host
+        self.port: int = port
+        self._runner: web.AppRunner | None = None
+
+    @staticmethod
+    async def _handle_metrics(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        print(f"✔ Metrics served on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
@@ -1,3 +1,4 @@
-from .guild_settings import GuildSettings
+from .guild_settings import GuildSettings, guild_settings_cache
+from .imported_emote import ImportedEmote
 
-__models__ = [GuildSettings]
+__models__ = [GuildSettings, ImportedEmote]
@@ -1,10 +1,17 @@
+import copy
+import asyncio
 import discord
 import config
+from collections import OrderedDict
 from tortoise.models import Model
 from tortoise import fields
+from tortoise.transactions import in_transaction
 from typing import Any
 from api import Emote
 from ctx import SubApplicationContext
+from write_behind import write_behind
+from metrics import db_save_seconds
+from .imported_emote import ImportedEmote
 
 
 class DuplicateEmoteIDRecord(Exception):
@@ -12,14 +19,41 @@ class DuplicateEmoteIDRecord(Exception):
         super().__init__(message)
 
 
+_DEFAULT_PERMISSIONS: dict[str, bool] = {command: bool(value) for command, value in config.DEFAULT_PERMISSIONS.items()}
+
+
 class GuildSettings(Model):
     guild_id = fields.IntField(primary_key=True, unique=True)
     permissions = fields.JSONField(default={})
-    emotes = fields.JSONField(default={})
+    emotes = fields.JSONField(default={})  # legacy, moved to ImportedEmote by migrate_emotes_json
+
+    # `permissions` compiled into sets: command -> (allowed role IDs, allowed user IDs), built on first check
+    _acl: dict[str, tuple[frozenset[int], frozenset[int]]] | None = None
+    # (member ID, command) -> (member's role IDs at the time, decision)
+    _decisions: dict[tuple[int, str], tuple[tuple, bool]] | None = None
 
     def __init__(self, **kwargs: Any):
         super().__init__(**kwargs)
 
+    async def save(self, *args, **kwargs):
+        # plain saves of existing rows can be deferred, anything with arguments (creation, transactions) can't
+        if write_behind.enabled and self._saved_in_db and not args and not kwargs:
+            write_behind.schedule(self)
+        else:
+            with db_save_seconds.time(operation="settings"):
+                await super().save(*args, **kwargs)
+
+        guild_settings_cache.put(self)
+
+    async def delete(self, *args, **kwargs):
+        await super().delete(*args, **kwargs)
+        guild_settings_cache.invalidate(self.guild_id)
+
+    @classmethod
+    async def get_or_create_cached(cls, guild_id: int) -> tuple["GuildSettings", bool]:
+        """Same as `get_or_create(guild_id=...)`, but served from memory when the guild was used recently."""
+        return await guild_settings_cache.get_or_create(guild_id)
+
     @staticmethod
     async def check_custom_permissions(ctx: SubApplicationContext) -> bool:
         """
@@ -42,33 +76,74 @@ class GuildSettings(Model):
 
         return self.permissions.get(command_name, config.DEFAULT_PERMISSIONS_VALUE_JSON)
 
+    def _compile_permissions(self):
+        self._acl = {
+            command_name: (frozenset(overrides["role"]), frozenset(overrides["user"]))
+            for command_name, overrides in self.permissions.items() if overrides
+        }
+        self._decisions = {}
+
+    def _command_acl(self, command_name: str) -> tuple[frozenset[int], frozenset[int]] | None:
+        """:return: (allowed role IDs, allowed user IDs) or None if the command has no overrides in this guild."""
+        if self._acl is None:
+            self._compile_permissions()
+
+        return self._acl.get(command_name)
+
+    def invalidate_permission_decisions(self):
+        """Has to be called when permissions of a role change, membership changes are noticed on their own."""
+        self._decisions = {}
+
     async def check_permissions_for(
             self, target: discord.Member | discord.Role, command: str | discord.ApplicationCommand
     ) -> bool:
+        command_name = command if type(command) is str else command.qualified_name
+
+        if type(target) is discord.Role:
+            return self._decide(target, command_name)
+
+        # member's roles are part of the key, so a role added or removed is a cache miss rather than a stale hit
+        roles_key = tuple(target._roles)  # noqa, no public access to role IDs without building Role objects
+        key = (target.id, command_name)
+
+        if self._acl is None:
+            self._compile_permissions()
+
+        cached = self._decisions.get(key)
+        if cached is not None and cached[0] == roles_key:
+            return cached[1]
+
+        decision = self._decide(target, command_name)
+
+        if len(self._decisions) >= config.PERMISSION_DECISIONS_CACHE_SIZE:
+            self._decisions = {}
+        self._decisions[key] = (roles_key, decision)
+
+        return decision
+
+    def _decide(self, target: discord.Member | discord.Role, command_name: str) -> bool:
         target_type: str = "role" if type(target) is discord.Role else "user"
         target_discord_permissions: discord.Permissions = \
             target.guild_permissions if target_type == "user" else target.permissions
-        command_name = command if type(command) is str else command.qualified_name
 
         if target_discord_permissions.administrator and config.IGNORE_OVERRIDES_IF_ADMINISTRATOR:
             return True
 
-        guild_permissions_list = self.permissions.get(command_name)
+        acl = self._command_acl(command_name)
 
-        if not guild_permissions_list:
-            return bool(config.DEFAULT_PERMISSIONS.get(command_name))
+        if acl is None:
+            return _DEFAULT_PERMISSIONS.get(command_name, False)
 
-        target_list_role: list[int] = guild_permissions_list["role"]
-        target_list_user: list[int] = guild_permissions_list["user"]
+        allowed_roles, allowed_users = acl
 
-        if target.id in target_list_user:
-            return True
+        if target_type == "role":
+            return target.id in allowed_roles
 
-        if type(target) is discord.Member:
-            if any(item.id in target_list_role for item in target.roles):
-                return True
+        if target.id in allowed_users:
+            return True
 
-        return False
+        # @everyone isn't part of member's roles, its ID is the guild's ID
+        return target.guild.id in allowed_roles or not allowed_roles.isdisjoint(target._roles)  # noqa
 
     async def register_permission(
             self, target: discord.Member | discord.Role, command: str,
@@ -77,7 +152,7 @@ class GuildSettings(Model):
         target_type: str = "role" if type(target) is discord.Role else "user"
 
         if not self.permissions.get(command):
-            self.permissions[command] = config.DEFAULT_PERMISSIONS_VALUE_JSON
+            self.permissions[command] = copy.deepcopy(config.DEFAULT_PERMISSIONS_VALUE_JSON)
 
         if value:
             if target.id not in self.permissions[command][target_type]:
@@ -86,51 +161,178 @@ class GuildSettings(Model):
             if target.id in self.permissions[command][target_type]:
                 self.permissions[command][target_type].remove(target.id)
 
+        # update the compiled form of this command only
+        if self._acl is not None:
+            self._acl[command] = (
+                frozenset(self.permissions[command]["role"]), frozenset(self.permissions[command]["user"])
+            )
+            self._decisions = {key: value for key, value in self._decisions.items() if key[1] != command}
+
         await self.save()
 
     async def register_emote(self, author: discord.Member, emote: Emote, discord_emote_id: int):
-        if not self.emotes.get(discord_emote_id):
-            self.emotes[discord_emote_id] = {
-                "seventv_id": emote.id,
-                "discord_id": discord_emote_id,
-                "author_id": author.id,
-                "animated": emote.animated
-            }
-
-            await self.save()
-            return
-
-        raise DuplicateEmoteIDRecord(f"Tried to create a DB record with duplicate discord emote ID: {discord_emote_id}")
+        if await ImportedEmote.exists(guild_id=self.guild_id, discord_id=discord_emote_id):
+            raise DuplicateEmoteIDRecord(
+                f"Tried to create a DB record with duplicate discord emote ID: {discord_emote_id}"
+            )
+
+        with db_save_seconds.time(operation="register_emote"):
+            await ImportedEmote.create(
+                guild_id=self.guild_id,
+                discord_id=discord_emote_id,
+                seventv_id=emote.id,
+                author_id=author.id,
+                animated=emote.animated
+            )
+
+    async def seventv_ids(self) -> set[str]:
+        return set(await ImportedEmote.filter(guild_id=self.guild_id).values_list("seventv_id", flat=True))
 
     async def emotes_by(self, target: discord.Member) -> list[int]:
-        return [
-            int(emote_key) for emote_key in self.emotes
-            if self.emotes[emote_key]["author_id"] == target.id
-        ]
+        return list(
+            await ImportedEmote.filter(guild_id=self.guild_id, author_id=target.id).values_list("discord_id", flat=True)
+        )
 
     async def get_emote_by_discord_id(self, emote_id: int) -> dict | None:
-        return self.emotes.get(str(emote_id), None)
+        emote = await ImportedEmote.get_or_none(guild_id=self.guild_id, discord_id=emote_id)
+
+        return emote.to_dict() if emote else None
 
     async def remove_emote(self, emote_id: int):
-        popped = self.emotes.pop(str(emote_id), None)
+        with db_save_seconds.time(operation="remove_emotes"):
+            await ImportedEmote.filter(guild_id=self.guild_id, discord_id=emote_id).delete()
+
+    async def remove_emotes(self, emote_ids: set[int]) -> int:
+        """Removes records of several emotes in a single query. :return: Amount of removed records."""
+        if not emote_ids:
+            return 0
 
-        if popped:
-            await self.save()
+        with db_save_seconds.time(operation="remove_emotes"):
+            return await ImportedEmote.filter(guild_id=self.guild_id, discord_id__in=emote_ids).delete()
+
+    @staticmethod
+    async def deleted_emoji_ids(guild: discord.Guild, registered: set[int]) -> set[int]:
+        """
+        Which of the `registered` emoji IDs are gone from the guild, going by the gateway cache. Only asks the REST API
+        when the cache is empty while we have records for the guild, so an unpopulated cache can't wipe them.
+        """
+        if not registered:
+            return set()
+
+        emoji_ids = {emoji.id for emoji in guild.emojis}
+
+        if not emoji_ids:
+            emoji_ids = {emoji.id for emoji in await guild.fetch_emojis()}
+
+        return registered - emoji_ids
+
+    @classmethod
+    async def unregister_deleted_emotes(cls, guild: discord.Guild) -> int:
+        """:return: Amount of removed records."""
+        registered = set(await ImportedEmote.filter(guild_id=guild.id).values_list("discord_id", flat=True))
+
+        deleted = await cls.deleted_emoji_ids(guild, registered)
+        if not deleted:
+            return 0
+
+        return await ImportedEmote.filter(guild_id=guild.id, discord_id__in=deleted).delete()
 
     @classmethod
-    async def unregister_deleted_emotes(cls, guild: discord.Guild):
-        guild_settings, created = await cls.get_or_create(guild_id=guild.id)
+    async def migrate_emotes_json(cls) -> int:
+        """
+        Moves emotes from the legacy `emotes` JSON column into the ImportedEmote table.
+        Safe to run on every start, guilds that were already migrated have an empty `emotes` column.
+        :return: Amount of migrated emotes.
+        """
+        migrated = 0
+
+        async with in_transaction():
+            for guild_settings in await cls.exclude(emotes={}):
+                existing = set(
+                    await ImportedEmote.filter(guild_id=guild_settings.guild_id).values_list("discord_id", flat=True)
+                )
+
+                await ImportedEmote.bulk_create([
+                    ImportedEmote(
+                        guild_id=guild_settings.guild_id,
+                        discord_id=int(emote["discord_id"]),
+                        seventv_id=emote["seventv_id"],
+                        author_id=emote["author_id"],
+                        animated=emote["animated"]
+                    )
+                    for emote in guild_settings.emotes.values()
+                    if int(emote["discord_id"]) not in existing
+                ])
+
+                migrated += len(guild_settings.emotes)
+                guild_settings.emotes = {}
+                await guild_settings.save(update_fields=["emotes"])
+
+        return migrated
+
+
+class GuildSettingsCache:
+    """
+    Process-wide LRU cache of GuildSettings, so command dispatch doesn't need a DB round trip.
+    Kept up to date by GuildSettings.save() (write-through), inactive guilds are evicted above `max_size`.
+    Everything that changes the DB without going through a model instance has to call `invalidate`.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._entries: OrderedDict[int, GuildSettings] = OrderedDict()
+        self._loading: dict[int, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, guild_id: int) -> GuildSettings | None:
+        guild_settings = self._entries.get(guild_id)
+
+        if guild_settings is not None:
+            self._entries.move_to_end(guild_id)
+
+        return guild_settings
+
+    def put(self, guild_settings: GuildSettings):
+        self._entries[guild_settings.guild_id] = guild_settings
+        self._entries.move_to_end(guild_settings.guild_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, guild_id: int):
+        self._entries.pop(guild_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def _load(self, guild_id: int) -> tuple[GuildSettings, bool]:
+        guild_settings, created = await GuildSettings.get_or_create(guild_id=guild_id)
+        self.put(guild_settings)
+
+        return guild_settings, created
+
+    async def get_or_create(self, guild_id: int) -> tuple[GuildSettings, bool]:
+        guild_settings = self.get(guild_id)
+        if guild_settings is not None:
+            self.hits += 1
+            return guild_settings, False
 
-        if created:
-            return
+        self.misses += 1
 
-        registered_emotes = [emote_key for emote_key in guild_settings.emotes]
-        guild_emotes = [str(x.id) for x in await guild.fetch_emojis()]
+        # concurrent misses for the same guild share one query, so they also share one instance
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = asyncio.create_task(self._load(guild_id))
+            self._loading[guild_id] = task
+            task.add_done_callback(lambda t: self._loading.pop(guild_id, None))
 
-        for emote in registered_emotes:
-            if emote in guild_emotes:
-                continue
+        return await asyncio.shield(task)
 
-            guild_settings.emotes.pop(emote)
 
-        await guild_settings.save()
+guild_settings_cache = GuildSettingsCache(config.GUILD_SETTINGS_CACHE_SIZE)
@@ -0,0 +1,25 @@
+from tortoise.models import Model
+from tortoise import fields
+
+
+class ImportedEmote(Model):
+    """A 7TV emote imported into a guild, one row per Discord emoji."""
+    id = fields.IntField(primary_key=True)
+    guild_id = fields.BigIntField()
+    discord_id = fields.BigIntField()
+    seventv_id = fields.CharField(max_length=32, db_index=True)
+    author_id = fields.BigIntField()
+    animated = fields.BooleanField(default=False)
+
+    class Meta:
+        table = "imported_emote"
+        unique_together = (("guild_id", "discord_id"),)
+        indexes = (("guild_id", "author_id"),)
+
+    def to_dict(self) -> dict:
+        return {
+            "seventv_id": self.seventv_id,
+            "discord_id": self.discord_id,
+            "author_id": self.author_id,
+            "animated": self.animated
+        }
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[Any], Awaitable[Any]]
+    concurrency: int = 1
+
+    processed: int = 0
+    failed: int = 0
+
+
+class Pipeline:
+    """
+    Runs items through stages, each stage with its own workers and a bounded queue in front of it,
+    so f.e downloads of the next items overlap with transcoding and uploading of the previous ones.
+
+    A stage function returns the item for the next stage, or None to drop it.
+    Exceptions are stored per item via `on_error` and don't stop the pipeline.
+    """
+
+    def __init__(
+            self, stages: list[Stage], queue_size: int = 4,
+            on_error: Callable[[Any, Stage, Exception], None] | None = None,
+            on_progress: Callable[[], Awaitable[None]] | None = None
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.on_progress = on_progress
+
+        self.results: list[Any] = []
+
+    async def _worker(self, stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue | None):
+        while True:
+            item = await inbox.get()
+
+            if item is _DONE:
+                # let the other workers of this stage see it as well
+                await inbox.put(_DONE)
+                return
+
+            try:
+                result = await stage.func(item)
+            except Exception as e:
+                stage.failed += 1
+                logger.debug(f"Pipeline stage {stage.name} failed for {item}: {e!r}")
+                if self.on_error:
+                    self.on_error(item, stage, e)
+                result = None
+            else:
+                stage.processed += 1
+
+            if result is not None:
+                if outbox is not None:
+                    await outbox.put(result)
+                else:
+                    self.results.append(result)
+
+            if self.on_progress:
+                await self.on_progress()
+
+    async def _run_stage(self, stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue | None):
+        await asyncio.gather(*(self._worker(stage, inbox, outbox) for _ in range(stage.concurrency)))
+
+        if outbox is not None:
+            await outbox.put(_DONE)
+
+    async def _feed(self, items: Iterable[Any], queue: asyncio.Queue):
+        for item in items:
+            await queue.put(item)
+
+        await queue.put(_DONE)
+
+    async def run(self, items: Iterable[Any]) -> list[Any]:
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        tasks = [asyncio.create_task(self._feed(items, queues[0]))]
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            tasks.append(asyncio.create_task(self._run_stage(stage, queues[index], outbox)))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return self.results
@@ -0,0 +1,71 @@
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+
+import discord
+from tortoise.transactions import in_transaction
+
+import config
+from models import GuildSettings, ImportedEmote
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReconcileReport:
+    guilds_checked: int
+    guilds_changed: int
+    pruned: int
+    duration: float
+
+
+async def reconcile_deleted_emotes(bot: discord.Bot) -> ReconcileReport:
+    """
+    Removes records of imported emotes that were deleted from their guild while the bot wasn't watching.
+    Guilds are checked concurrently (bounded), all removals are written in a single transaction.
+    Guilds the bot isn't in (anymore) are left alone.
+    """
+    started_at = time.perf_counter()
+
+    registered: defaultdict[int, set[int]] = defaultdict(set)
+    for guild_id, discord_id in await ImportedEmote.all().values_list("guild_id", "discord_id"):
+        registered[guild_id].add(discord_id)
+
+    semaphore = asyncio.Semaphore(config.RECONCILE_CONCURRENCY)
+    deleted: dict[int, set[int]] = {}
+
+    async def check(guild: discord.Guild):
+        async with semaphore:
+            try:
+                stale = await GuildSettings.deleted_emoji_ids(guild, registered[guild.id])
+            except discord.HTTPException as e:
+                logger.warning(f"Failed to fetch emojis of guild {guild.id}, skipping it: {e}")
+                return
+            except Exception as e:
+                logger.exception(f"Failed to check emojis of guild {guild.id}, skipping it", exc_info=e)
+                return
+
+        if stale:
+            deleted[guild.id] = stale
+
+    guilds = [
+        guild for guild_id in registered
+        if (guild := bot.get_guild(guild_id)) is not None and not guild.unavailable
+    ]
+    await asyncio.gather(*(check(guild) for guild in guilds))
+
+    pruned = 0
+    if deleted:
+        async with in_transaction():
+            for guild_id, stale in deleted.items():
+                pruned += await ImportedEmote.filter(guild_id=guild_id, discord_id__in=stale).delete()
+
+    report = ReconcileReport(len(guilds), len(deleted), pruned, time.perf_counter() - started_at)
+    logger.info(
+        f"Reconciled deleted emotes: checked {report.guilds_checked} guilds, pruned {report.pruned} records "
+        f"in {report.guilds_changed} guilds, took {report.duration:.2f}s"
+    )
+
+    return report
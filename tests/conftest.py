@@ -0,0 +1,32 @@
+import os
+import sys
+import asyncio
+
+import pytest
+from tortoise import Tortoise
+
+# modules are imported the way main.py imports them, relative to the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import guild_settings_cache  # noqa: E402, needs the path above
+
+
+@pytest.fixture
+def with_db():
+    """
+    Runs a coroutine function against a fresh in-memory database. Tortoise's connections are bound to the event loop,
+    so setup, the test and teardown all run in a single asyncio.run.
+    """
+    def run(test):
+        async def wrapper():
+            await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["models"]})
+            await Tortoise.generate_schemas()
+            try:
+                return await test()
+            finally:
+                await Tortoise.close_connections()
+                guild_settings_cache.clear()
+
+        return asyncio.run(wrapper())
+
+    return run
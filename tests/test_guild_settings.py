@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+
+import pytest
+
+from api import Emote
+from models import GuildSettings, ImportedEmote
+from models.guild_settings import DuplicateEmoteIDRecord
+
+
+def legacy_emote(discord_id: int, seventv_id: str, author_id: int = 1, animated: bool = False) -> dict:
+    # the legacy JSON column stored IDs as strings or ints depending on the bot version that wrote them
+    return {"discord_id": str(discord_id), "seventv_id": seventv_id, "author_id": author_id, "animated": animated}
+
+
+def test_migration_moves_legacy_emotes_into_the_table(with_db):
+    async def test():
+        await GuildSettings.create(
+            guild_id=1, emotes={"10": legacy_emote(10, "a"), "11": legacy_emote(11, "b", 2, True)}
+        )
+        await GuildSettings.create(guild_id=2, emotes={"20": legacy_emote(20, "c")})
+        await GuildSettings.create(guild_id=3)
+
+        assert await GuildSettings.migrate_emotes_json() == 3
+
+        rows = await ImportedEmote.all().order_by("discord_id").values_list(
+            "guild_id", "discord_id", "seventv_id", "author_id", "animated"
+        )
+        assert rows == [(1, 10, "a", 1, False), (1, 11, "b", 2, True), (2, 20, "c", 1, False)]
+
+        for guild_settings in await GuildSettings.all():
+            assert guild_settings.emotes == {}
+
+    with_db(test)
+
+
+def test_migration_is_idempotent_and_skips_existing_rows(with_db):
+    async def test():
+        await ImportedEmote.create(guild_id=1, discord_id=10, seventv_id="a", author_id=1)
+        await GuildSettings.create(guild_id=1, emotes={"10": legacy_emote(10, "a"), "11": legacy_emote(11, "b")})
+
+        await GuildSettings.migrate_emotes_json()
+        assert await GuildSettings.migrate_emotes_json() == 0
+
+        assert sorted(await ImportedEmote.filter(guild_id=1).values_list("discord_id", flat=True)) == [10, 11]
+
+    with_db(test)
+
+
+def test_register_and_remove_emotes(with_db):
+    async def test():
+        guild_settings = await GuildSettings.create(guild_id=1)
+        author = SimpleNamespace(id=5)
+        emote = Emote(
+            id="abc", name="peepo", format="gif", animated=True, width=128, height=128,
+            emote_url="https://cdn.7tv.app/emote/abc/4x.gif", emote_bytes=b""
+        )
+
+        await guild_settings.register_emote(author, emote, 100)
+        await guild_settings.register_emote(author, emote, 101)
+
+        with pytest.raises(DuplicateEmoteIDRecord):
+            await guild_settings.register_emote(author, emote, 100)
+
+        assert await guild_settings.seventv_ids() == {"abc"}
+        assert sorted(await guild_settings.emotes_by(author)) == [100, 101]
+        assert (await guild_settings.get_emote_by_discord_id(100))["animated"] is True
+
+        assert await guild_settings.remove_emotes({100, 101, 999}) == 2
+        assert await guild_settings.get_emote_by_discord_id(100) is None
+
+    with_db(test)
+
+
+def test_unregister_deleted_emotes_keeps_records_of_emojis_still_there(with_db):
+    async def test():
+        for discord_id in (10, 11):
+            await ImportedEmote.create(guild_id=1, discord_id=discord_id, seventv_id="x", author_id=1)
+
+        guild = SimpleNamespace(id=1, emojis=[SimpleNamespace(id=10)])
+
+        assert await GuildSettings.unregister_deleted_emotes(guild) == 1  # noqa
+        assert await ImportedEmote.all().values_list("discord_id", flat=True) == [10]
+
+    with_db(test)
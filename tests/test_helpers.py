@@ -0,0 +1,13 @@
+import pytest
+
+from helpers import to_discord_emoji_name
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("peepo Happy-1", "peepo_Happy_1"),
+    ("a", "a_"),
+    ("ü", "emoji"),
+    ("x" * 40, "x" * 32),
+])
+def test_emoji_names_are_what_discord_accepts(name, expected):
+    assert to_discord_emoji_name(name) == expected
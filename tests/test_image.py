@@ -0,0 +1,63 @@
+import io
+
+import pytest
+from PIL import Image
+
+import config
+from api import image
+from benchmarks.image_bench import CORPUS, generate
+
+CASES = {case.name: case for case in CORPUS}
+
+
+@pytest.fixture
+def full_encodes(monkeypatch) -> list[tuple[int, int | None]]:
+    """(compress factor, palette size) of every full encode made."""
+    encodes = []
+    process_gif = image.process_gif
+
+    def counting_process_gif(*args, **kwargs):
+        encodes.append((kwargs.get("compress_factor"), kwargs.get("colors")))
+        return process_gif(*args, **kwargs)
+
+    monkeypatch.setattr(image, "process_gif", counting_process_gif)
+    return encodes
+
+
+@pytest.mark.parametrize("downscaled_misprediction", [1.0, 0.1, 0.01])
+@pytest.mark.parametrize("case", ["gif-128-120f-noisy", "gif-256-300f"])
+def test_gif_fits_within_the_full_encode_budget(monkeypatch, full_encodes, case, downscaled_misprediction):
+    # Trial encodes of downscaled sides claiming much smaller frames than they turn out to be. A single correction
+    # factor can't fix errors that differ per side, every level picked from then on misses.
+    estimate = image.estimate_gif_frame_size
+    monkeypatch.setattr(
+        image, "estimate_gif_frame_size",
+        lambda source, colors=None: estimate(source, colors) * (
+            1 if max(source.target_size) >= 128 else downscaled_misprediction
+        )
+    )
+    monkeypatch.setattr(config, "EMOJI_SIZE_LIMIT", 4 * 1024)  # forces both cases to the bottom of the ladder
+
+    result = image.format_emote_for_discord(generate(CASES[case]))
+
+    assert len(result) < config.EMOJI_SIZE_LIMIT
+    assert 1 <= len(full_encodes) <= 2
+    assert Image.open(io.BytesIO(result)).n_frames > 1  # something animated fits, no need for a single frame
+
+
+def test_small_gif_is_kept_as_is(full_encodes):
+    result = Image.open(io.BytesIO(image.format_emote_for_discord(generate(CASES["gif-128-24f"]))))
+
+    assert result.size == (128, 128)
+    assert result.n_frames == 24
+    assert full_encodes == [(1, config.GIF_PALETTE_SIZES[0])]
+
+
+def test_levels_end_with_a_single_frame():
+    levels = image._encode_levels([None, 96, 32], [256, 64], n_frames=40)  # noqa
+
+    assert levels[0] == (None, 1, 256)
+    assert levels[-1] == (32, 40, 64)
+    assert [compress_factor for _, compress_factor, _ in levels] == sorted(
+        compress_factor for _, compress_factor, _ in levels
+    )
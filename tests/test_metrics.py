@@ -0,0 +1,13 @@
+import metrics
+
+
+def test_function_backed_values_are_read_when_asked_for():
+    registry = metrics.Registry()
+    jobs = registry.register(metrics.Gauge("jobs", "Jobs.", ("state",)))
+    pending = [3]
+
+    jobs.set_function(lambda: pending[0], state="queued")
+    pending[0] = 5
+
+    assert jobs.get(state="queued") == 5
+    assert 'jobs{state="queued"} 5' in registry.render()
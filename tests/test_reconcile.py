@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import cogs.emotes
+from models import ImportedEmote
+from reconcile import reconcile_deleted_emotes
+
+
+class FakeBot:
+    def __init__(self, *guilds):
+        self.guilds = {guild.id: guild for guild in guilds}
+
+    def get_guild(self, guild_id: int):
+        return self.guilds.get(guild_id)
+
+
+def make_guild(guild_id: int, emoji_ids: list[int], fetch_error: Exception | None = None):
+    async def fetch_emojis():
+        raise fetch_error
+
+    return SimpleNamespace(
+        id=guild_id, unavailable=False, emojis=[SimpleNamespace(id=emoji_id) for emoji_id in emoji_ids],
+        fetch_emojis=fetch_emojis
+    )
+
+
+async def register(guild_id: int, *discord_ids: int):
+    for discord_id in discord_ids:
+        await ImportedEmote.create(guild_id=guild_id, discord_id=discord_id, seventv_id="x", author_id=1)
+
+
+@pytest.mark.parametrize("error", [RuntimeError("unexpected"), discord.DiscordException("gateway")])
+def test_failing_guild_is_skipped_and_others_are_pruned(with_db, error):
+    async def test():
+        await register(1, 10, 11)
+        await register(2, 20)  # empty gateway cache, falls back to fetch_emojis, which fails
+
+        report = await reconcile_deleted_emotes(FakeBot(make_guild(1, [10]), make_guild(2, [], error)))
+
+        assert report.pruned == 1
+        assert set(await ImportedEmote.all().values_list("discord_id", flat=True)) == {10, 20}
+
+    with_db(test)
+
+
+def test_reconcile_loop_survives_a_failed_run(monkeypatch):
+    async def failing_reconcile(bot):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(cogs.emotes, "reconcile_deleted_emotes", failing_reconcile)
+    cog = cogs.emotes.EmotesCog(FakeBot())
+
+    asyncio.run(cog.reconcile_loop.coro(cog))  # logged, not raised, so tasks.loop keeps going
@@ -0,0 +1,57 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from api.errors import TranscoderCrashed, TranscodeTimeout
+from api.transcoder import Transcoder
+
+
+# module level, so spawned workers can import them
+
+def crash():
+    os._exit(1)  # noqa, same as the worker being OOM-killed
+
+
+def double(value: int) -> int:
+    return value * 2
+
+
+def sleep(seconds: float):
+    time.sleep(seconds)
+
+
+def test_crashed_worker_fails_its_job_and_the_pool_is_replaced():
+    transcoder = Transcoder(max_workers=1, max_queue=1, job_timeout=30)
+
+    async def run():
+        with pytest.raises(TranscoderCrashed):
+            await transcoder.submit(crash)
+
+        assert await transcoder.submit(double, 21) == 42
+
+    try:
+        asyncio.run(run())
+    finally:
+        transcoder.shutdown()
+
+
+def test_timed_out_job_keeps_its_slot_until_it_finishes():
+    transcoder = Transcoder(max_workers=1, max_queue=0, job_timeout=30)
+
+    async def run():
+        await transcoder.submit(double, 1)  # spawning the worker takes a while, not part of what's tested
+        transcoder.job_timeout = 0.2
+
+        with pytest.raises(TranscodeTimeout):
+            await transcoder.submit(sleep, 1)
+        assert transcoder.pending == 1  # still running in the worker
+
+        await asyncio.sleep(1.5)
+        assert transcoder.pending == 0
+
+    try:
+        asyncio.run(run())
+    finally:
+        transcoder.shutdown()
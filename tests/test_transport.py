@@ -0,0 +1,128 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+import config
+import metrics
+from api.errors import SevenTVUnavailable
+from api.transport import CircuitBreaker, Transport
+
+
+class FakeResponse:
+    def __init__(self, status: int):
+        self.status = status
+        self.headers = {}
+
+    def release(self):
+        pass
+
+
+class FakeSession:
+    """Stands in for aiohttp.ClientSession, each request pops the next outcome (status or exception)."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = 0
+
+    async def request(self, method, url, **kwargs):
+        self.requests += 1
+        outcome = self.outcomes.pop(0)
+
+        if isinstance(outcome, BaseException):
+            raise outcome
+
+        return FakeResponse(outcome)
+
+
+def make_transport(*outcomes) -> Transport:
+    transport = Transport()
+    transport._session = FakeSession(*outcomes)
+    return transport
+
+
+def half_open(breaker: CircuitBreaker):
+    breaker.opened_at = -breaker.reset_timeout  # time.monotonic() is always past that
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delays(monkeypatch):
+    monkeypatch.setattr(config, "HTTP_RETRIES", 0)
+    monkeypatch.setattr(config, "HTTP_BREAKER_FAILURE_THRESHOLD", 2)
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_timeout():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+
+    half_open(breaker)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # only one trial at a time
+
+
+def test_breaker_trial_result_closes_or_reopens():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.failures = 2
+    half_open(breaker)
+
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    half_open(breaker)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_connection_errors_open_the_breaker():
+    transport = make_transport(aiohttp.ClientConnectionError(), aiohttp.ClientConnectionError())
+
+    for _ in range(2):
+        with pytest.raises(SevenTVUnavailable):
+            asyncio.run(transport.get("https://7tv.io/v3/emotes/a"))
+
+    assert transport.breaker_for("7tv.io").state == CircuitBreaker.OPEN
+    assert metrics.http_breaker_open.get(host="7tv.io") == 1
+
+    with pytest.raises(SevenTVUnavailable):
+        asyncio.run(transport.get("https://7tv.io/v3/emotes/a"))
+    assert transport._session.requests == 2  # failed fast, without sending anything
+
+
+@pytest.mark.parametrize("error", [
+    asyncio.CancelledError(),
+    aiohttp.InvalidURL("https://7tv.io/%"),
+    aiohttp.ClientPayloadError("payload"),
+    ValueError("anything else"),
+])
+def test_other_exceptions_during_trial_dont_block_the_host(error):
+    transport = make_transport(error, 200)
+    breaker = transport.breaker_for("7tv.io")
+    breaker.failures = 2
+    half_open(breaker)
+
+    with pytest.raises(type(error)):
+        asyncio.run(transport.get("https://7tv.io/v3/emotes/a"))
+
+    # the next request is let through as a new trial, and its success closes the breaker
+    response = asyncio.run(transport.get("https://7tv.io/v3/emotes/a"))
+    assert response.status == 200
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_server_errors_count_as_failures():
+    transport = make_transport(503, 503)
+
+    for _ in range(2):
+        assert asyncio.run(transport.get("https://7tv.io/v3/emotes/a")).status == 503
+
+    assert transport.breaker_for("7tv.io").state == CircuitBreaker.OPEN
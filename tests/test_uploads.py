@@ -0,0 +1,159 @@
+import json
+import asyncio
+
+import discord
+import pytest
+
+import config
+from bot import bot
+from uploads import UploadScheduler, EmojiUploadRateLimited, _RateLimitListener
+
+GUILD_ID = 1234
+
+
+class FakeResponse:
+    def __init__(self, status: int, data: dict, headers: dict | None = None):
+        self.status = status
+        self.reason = "Too Many Requests" if status == 429 else "OK"
+        self.headers = {"content-type": "application/json", "Via": "1.1 google", **(headers or {})}
+        self._text = json.dumps(data)
+
+    async def text(self, encoding: str = "utf-8") -> str:
+        return self._text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeSession:
+    """Replaces the aiohttp session inside py-cord's HTTPClient, so its real request handling runs."""
+
+    def __init__(self, *responses: FakeResponse):
+        self.responses = list(responses)
+        self.requests: list[tuple[str, str, dict]] = []
+
+    def request(self, method: str, url: str, **kwargs) -> FakeResponse:
+        self.requests.append((method, url, kwargs))
+        return self.responses.pop(0)
+
+
+def emoji_data(name: str) -> dict:
+    return {"id": "987", "name": name, "animated": False, "require_colons": True, "managed": False, "available": True}
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(*responses: FakeResponse) -> FakeSession:
+        fake = FakeSession(*responses)
+        monkeypatch.setattr(bot.http, "_HTTPClient__session", fake, raising=False)
+        monkeypatch.setattr(bot.http, "token", "token")
+        return fake
+
+    yield install
+    bot.http._locks.clear()  # noqa, buckets py-cord is still holding would block the next test
+
+    return install
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = UploadScheduler(bot)
+    listener = _RateLimitListener(scheduler)
+
+    http_logger = discord.http._log  # noqa
+    http_logger.addFilter(listener)
+    yield scheduler
+    http_logger.removeFilter(listener)
+
+
+def make_guild() -> discord.Guild:
+    return discord.Guild(data={"id": GUILD_ID, "name": "guild"}, state=bot._connection)  # noqa
+
+
+def test_upload_posts_through_pycord(session, scheduler):
+    fake = session(FakeResponse(201, emoji_data("peepoHappy")))
+
+    async def run():
+        return await scheduler.upload(make_guild(), 1, name="peepoHappy", image=b"GIF89a", reason="imported")
+
+    emoji = asyncio.run(run())
+
+    assert isinstance(emoji, discord.Emoji)
+    assert emoji.id == 987 and emoji.name == "peepoHappy"
+
+    method, url, kwargs = fake.requests[0]
+    assert method == "POST" and url.endswith(f"/guilds/{GUILD_ID}/emojis")
+    assert kwargs["headers"]["Authorization"] == "Bot token"
+    assert kwargs["headers"]["X-Audit-Log-Reason"] == "imported"
+    assert json.loads(kwargs["data"])["image"].startswith("data:image/gif;base64,")
+
+
+def test_short_rate_limit_is_waited_out_and_learned(session, scheduler):
+    fake = session(FakeResponse(429, {"retry_after": 0.05, "global": False}), FakeResponse(201, emoji_data("a")))
+
+    async def run():
+        job = scheduler.submit(make_guild(), 1, name="a", image=b"GIF89a")
+        emoji = await job.wait()
+        return emoji, scheduler.queue_for(GUILD_ID).reset_at
+
+    emoji, reset_at = asyncio.run(run())
+
+    assert emoji.name == "a"
+    assert len(fake.requests) == 2
+    assert reset_at > 0
+
+
+def test_long_rate_limit_fails_instead_of_sleeping(session, scheduler, monkeypatch):
+    monkeypatch.setattr(config, "UPLOAD_MAX_WAIT", 1)
+    session(FakeResponse(429, {"retry_after": 3600, "global": False}))
+
+    async def run():
+        first = scheduler.submit(make_guild(), 1, name="a", image=b"GIF89a")
+        with pytest.raises(EmojiUploadRateLimited):
+            await asyncio.wait_for(first.wait(), timeout=5)
+
+        # the queue knows, later uploads fail right away
+        with pytest.raises(EmojiUploadRateLimited):
+            scheduler.submit(make_guild(), 1, name="b", image=b"GIF89a")
+
+    asyncio.run(run())
+
+
+def test_exhausted_bucket_fails_instead_of_waiting_for_the_reset(session, scheduler, monkeypatch):
+    monkeypatch.setattr(config, "UPLOAD_MAX_WAIT", 0.5)
+    # py-cord only logs this at debug level and holds the bucket until the reset
+    headers = {"X-Ratelimit-Remaining": "0", "X-Ratelimit-Reset-After": "3600", "X-Ratelimit-Bucket": "emojis"}
+    fake = session(FakeResponse(201, emoji_data("a"), headers), FakeResponse(201, emoji_data("b")))
+
+    async def run():
+        first = scheduler.submit(make_guild(), 1, name="a", image=b"GIF89a")
+        second = scheduler.submit(make_guild(), 1, name="b", image=b"GIF89a")
+        third = scheduler.submit(make_guild(), 2, name="c", image=b"GIF89a")
+
+        assert (await first.wait()).name == "a"
+        for job in (second, third):
+            with pytest.raises(EmojiUploadRateLimited):
+                await asyncio.wait_for(job.wait(), timeout=5)
+
+        later = scheduler.submit(make_guild(), 1, name="d", image=b"GIF89a")
+        _, eta = scheduler.position(later)
+        later.future.cancel()
+        return eta
+
+    eta = asyncio.run(run())
+
+    assert len(fake.requests) == 1
+    assert eta >= 0.4
+
+
+def test_errors_are_set_on_the_job(session, scheduler):
+    session(FakeResponse(403, {"message": "Missing Permissions", "code": 50013}))
+
+    async def run():
+        await scheduler.upload(make_guild(), 1, name="a", image=b"GIF89a")
+
+    with pytest.raises(discord.Forbidden):
+        asyncio.run(run())
@@ -0,0 +1,239 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+import discord
+
+import config
+from bot import bot
+from metrics import discord_upload_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class EmojiUploadRateLimited(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Emoji uploads for this server are rate limited for {retry_after:.0f} more seconds.")
+
+
+@dataclass
+class UploadJob:
+    guild: discord.Guild
+    user_id: int
+    name: str
+    image: bytes
+    roles: list[discord.Role] | None = None
+    reason: str | None = None
+
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+    async def wait(self) -> discord.Emoji:
+        return await asyncio.shield(self.future)
+
+
+class GuildUploadQueue:
+    """
+    Uploads of a single guild. Jobs are taken round-robin across users, so one user's batch can't starve others,
+    and the time until the emoji rate limit bucket refills is learned from Discord's 429s and uploads held up too long.
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id: int = guild_id
+
+        self.reset_at: float = 0  # time.monotonic() when the bucket refills, after being rate limited
+        self.average_upload_time: float = config.UPLOAD_DEFAULT_DURATION
+
+        self._jobs: OrderedDict[int, deque[UploadJob]] = OrderedDict()  # user id -> their jobs
+        self.worker: asyncio.Task | None = None
+        self.upload: asyncio.Task | None = None  # the emoji creation in progress
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._jobs.values())
+
+    def push(self, job: UploadJob, front: bool = False):
+        jobs = self._jobs.setdefault(job.user_id, deque())
+
+        if front:
+            jobs.appendleft(job)
+            self._jobs.move_to_end(job.user_id, last=False)
+        else:
+            jobs.append(job)
+
+    def pop(self) -> UploadJob:
+        user_id, jobs = next(iter(self._jobs.items()))
+        job = jobs.popleft()
+
+        # user goes to the back of the line
+        del self._jobs[user_id]
+        if jobs:
+            self._jobs[user_id] = jobs
+
+        return job
+
+    def order(self) -> list[UploadJob]:
+        """Jobs in the order they'll be uploaded in."""
+        queues = [list(jobs) for jobs in self._jobs.values()]
+        ordered = []
+
+        for index in range(max((len(jobs) for jobs in queues), default=0)):
+            ordered.extend(jobs[index] for jobs in queues if index < len(jobs))
+
+        return ordered
+
+    @property
+    def wait_time(self) -> float:
+        """Seconds until the next upload is allowed."""
+        return max(0.0, self.reset_at - time.monotonic())
+
+    def estimate(self, position: int) -> float:
+        """Rough amount of seconds until the job at `position` (0 is next) is uploaded."""
+        return (position + 1) * self.average_upload_time + self.wait_time
+
+    def rate_limited(self, retry_after: float):
+        self.reset_at = time.monotonic() + retry_after
+
+
+class UploadScheduler:
+    """
+    Schedules `guild.create_custom_emoji` calls. Each guild has its own queue and worker, so guilds upload in parallel.
+    py-cord waits out rate limits on its own (429s and buckets its headers say are used up) and doesn't expose them,
+    so every upload is given at most `UPLOAD_MAX_WAIT` seconds, anything slower marks the guild as rate limited.
+    429s it does warn about are also picked up (see `_RateLimitListener`) to keep ETAs right sooner.
+    """
+
+    def __init__(self, bot: discord.Bot):
+        self.bot = bot
+        self._queues: dict[int, GuildUploadQueue] = {}
+
+    def queue_for(self, guild_id: int) -> GuildUploadQueue:
+        if guild_id not in self._queues:
+            self._queues[guild_id] = GuildUploadQueue(guild_id)
+
+        return self._queues[guild_id]
+
+    def submit(
+            self, guild: discord.Guild, user_id: int, name: str, image: bytes,
+            roles: list[discord.Role] | None = None, reason: str | None = None
+    ) -> UploadJob:
+        job = UploadJob(guild, user_id, name, image, roles, reason)
+        queue = self.queue_for(guild.id)
+
+        if queue.wait_time > config.UPLOAD_MAX_WAIT:
+            raise EmojiUploadRateLimited(queue.wait_time)
+
+        queue.push(job)
+
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.create_task(self._work(queue))
+
+        return job
+
+    def position(self, job: UploadJob) -> tuple[int, float]:
+        """:return: Position of the job in its guild's queue (0 is next) and a rough ETA in seconds."""
+        queue = self.queue_for(job.guild.id)
+        order = queue.order()
+
+        position = order.index(job) if job in order else 0
+        return position, queue.estimate(position)
+
+    async def upload(self, *args, **kwargs) -> discord.Emoji:
+        return await self.submit(*args, **kwargs).wait()
+
+    def rate_limited(self, guild_id: int, retry_after: float):
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            return
+
+        queue.rate_limited(retry_after)
+
+        if retry_after > config.UPLOAD_MAX_WAIT and queue.upload is not None and not queue.upload.done():
+            # py-cord would sleep through it, holding up the whole queue
+            queue.upload.cancel()
+
+    async def _work(self, queue: GuildUploadQueue):
+        while len(queue):
+            if queue.wait_time > config.UPLOAD_MAX_WAIT:
+                # nobody is going to wait that long, fail everything that is queued
+                self._fail_queued(queue, EmojiUploadRateLimited(queue.wait_time))
+                return
+
+            await asyncio.sleep(queue.wait_time)
+
+            job = queue.pop()
+            if job.future.done():
+                continue
+
+            started_at = time.monotonic()
+            try:
+                with discord_upload_seconds.time():
+                    emoji = await self._post(queue, job)
+            except EmojiUploadRateLimited as e:
+                # the rest would be stuck behind the same rate limit
+                job.future.set_exception(e)
+                self._fail_queued(queue, e)
+                return
+            except Exception as e:
+                job.future.set_exception(e)
+                continue
+
+            queue.average_upload_time = queue.average_upload_time * 0.8 + (time.monotonic() - started_at) * 0.2
+            job.future.set_result(emoji)
+
+    @staticmethod
+    def _fail_queued(queue: GuildUploadQueue, error: Exception):
+        while len(queue):
+            job = queue.pop()
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    async def _post(self, queue: GuildUploadQueue, job: UploadJob) -> discord.Emoji:
+        # its own task, so a rate limit too long to wait for can cancel it without stopping the worker
+        queue.upload = asyncio.create_task(
+            job.guild.create_custom_emoji(name=job.name, image=job.image, roles=job.roles or [], reason=job.reason)
+        )
+
+        try:
+            async with asyncio.timeout(max(0.0, config.UPLOAD_MAX_WAIT - queue.wait_time)):
+                return await queue.upload
+        except TimeoutError:
+            # py-cord is sleeping through a rate limit it didn't tell about, it's at least this long
+            logger.warning(f"Emoji upload in guild {queue.guild_id} took over {config.UPLOAD_MAX_WAIT}s, rate limited")
+            queue.rate_limited(max(queue.wait_time, config.UPLOAD_MAX_WAIT))
+            raise EmojiUploadRateLimited(queue.wait_time) from None
+        except asyncio.CancelledError:
+            if queue.upload.cancelled() and not asyncio.current_task().cancelling():
+                raise EmojiUploadRateLimited(queue.wait_time)
+            raise
+        finally:
+            queue.upload = None
+
+
+class _RateLimitListener(logging.Filter):
+    """
+    Reads py-cord's "We are being rate limited" warnings, the only place it tells about 429s it handles, so a long one
+    fails the upload right away instead of once `UPLOAD_MAX_WAIT` runs out.
+    Their arguments are the retry_after and the bucket, "{channel_id}:{guild_id}:{path}".
+    """
+
+    def __init__(self, scheduler: UploadScheduler):
+        super().__init__()
+        self.scheduler: UploadScheduler = scheduler
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno == logging.WARNING and isinstance(record.args, tuple) and len(record.args) == 2:
+            retry_after, bucket = record.args
+
+            if isinstance(retry_after, (int, float)) and isinstance(bucket, str) and bucket.endswith("/emojis"):
+                _, guild_id, _ = bucket.split(":", 2)
+                if guild_id.isdigit():
+                    logger.warning(f"Emoji uploads rate limited in guild {guild_id} for {retry_after:.1f}s")
+                    self.scheduler.rate_limited(int(guild_id), float(retry_after))
+
+        return True
+
+
+upload_scheduler = UploadScheduler(bot)
+logging.getLogger("discord.http").addFilter(_RateLimitListener(upload_scheduler))
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
+import config
+from metrics import db_save_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Collects model saves and writes them periodically in a single transaction, instead of one commit per save.
+    Saving the same instance several times between flushes only writes it once.
+    """
+
+    def __init__(self, interval: float):
+        self.interval: float = interval
+        self.flushed: int = 0
+
+        self._dirty: dict[tuple[type, int], Model] = {}
+        self._task: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def schedule(self, instance: Model):
+        self._dirty[(type(instance), instance.pk)] = instance
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"Write-behind flush failed, retrying in {self.interval}s", exc_info=e)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        batch, self._dirty = self._dirty, {}
+
+        try:
+            with db_save_seconds.time(operation="write_behind_flush"):
+                async with in_transaction() as connection:
+                    for instance in batch.values():
+                        await instance.save(using_db=connection)
+        except Exception:
+            # newer saves of the same instances win, everything else goes back in the queue
+            self._dirty = {**batch, **self._dirty}
+            raise
+
+        self.flushed += len(batch)
+        logger.debug(f"Write-behind flushed {len(batch)} instances")
+
+    async def stop(self):
+        """Stops the periodic flushing and writes whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self.flush()
+
+
+write_behind = WriteBehind(config.DB_WRITE_BEHIND_INTERVAL)